@@ -24,7 +24,8 @@ from diglib.gui import GUI
 
 def main(library_dir):
     try:
-        library = DigitalLibrary(library_dir, XapianIndex, SQLAlchemyDatabase)
+        library = DigitalLibrary(library_dir, XapianIndex, SQLAlchemyDatabase,
+                                 defer_thumbnails=True)
         gui = GUI(library)
         gui.start()
         library.close()
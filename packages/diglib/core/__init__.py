@@ -17,35 +17,74 @@
 # with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import os
-import hashlib
+import sys
+import time
+import Queue
+import functools
+import collections
+import threading
+import traceback
+import multiprocessing
+import multiprocessing.pool
 
-import magic
 import ssdeep
 
 from diglib.core import error
-from diglib.core.lang import get_lang
-from diglib.core.handlers import get_handler
+from diglib.core import ingest
+from diglib.core.ingest import (scan_doc, extract_doc, place_doc,
+                                render_thumbnails, Scanner, Extractor)
+from diglib.core.cache import DocumentCache
+from diglib.core.journal import ImportJournal, get_file_stat
+from diglib.core.similarity import SimilarityIndex
 
 
+# Directories of a library, shared by all its Document objects.
+
+class LibraryPaths(object):
+
+    __slots__ = ('documents_dir', 'thumbnails_dir')
+
+    def __init__(self, documents_dir, thumbnails_dir):
+        self.documents_dir = documents_dir
+        self.thumbnails_dir = thumbnails_dir
+
+
+# A document of the library. Many documents can be in memory at the same
+# time (e.g. the results of a search), so the attributes are kept in slots
+# and the absolute paths are resolved using the LibraryPaths of the library
+# instead of keeping the directories in each document.
+
 class Document(object):
 
+    __slots__ = ('hash_md5', 'hash_ssdeep', 'mime_type', 'document_path',
+                 'document_size', 'small_thumbnail_path', 'normal_thumbnail_path',
+                 'large_thumbnail_path', 'language_code', 'tags', '_paths')
+
+    # Value of the thumbnail paths of a document whose thumbnails have not been
+    # generated yet. The paths are None if the document does not have thumbnails.
+    THUMBNAIL_PENDING = ''
+
+    @property
+    def thumbnails_pending(self):
+        return self.large_thumbnail_path == self.THUMBNAIL_PENDING
+
     @property
     def document_abspath(self):
-        return os.path.join(self._documents_dir, self.document_path)
+        return os.path.join(self._paths.documents_dir, self.document_path)
 
     @property
     def small_thumbnail_abspath(self):
-        return (os.path.join(self._thumbnails_dir, self.small_thumbnail_path)
+        return (os.path.join(self._paths.thumbnails_dir, self.small_thumbnail_path)
                 if self.small_thumbnail_path else self.small_thumbnail_path)
 
     @property
     def normal_thumbnail_abspath(self):
-        return (os.path.join(self._thumbnails_dir, self.normal_thumbnail_path)
+        return (os.path.join(self._paths.thumbnails_dir, self.normal_thumbnail_path)
                 if self.normal_thumbnail_path else self.normal_thumbnail_path)
 
     @property
     def large_thumbnail_abspath(self):
-        return (os.path.join(self._thumbnails_dir, self.large_thumbnail_path)
+        return (os.path.join(self._paths.thumbnails_dir, self.large_thumbnail_path)
                 if self.large_thumbnail_path else self.large_thumbnail_path)
 
     def __init__(self, hash_md5, hash_ssdeep, mime_type, document_path,
@@ -54,21 +93,17 @@ class Document(object):
         self.hash_md5 = hash_md5
         self.hash_ssdeep = hash_ssdeep
         self.mime_type = mime_type
-        self._documents_dir = None # Set by DigitalLibrary.
         self.document_path = document_path
         self.document_size = document_size
-        self._thumbnails_dir = None # Set by DigitalLibrary.
         self.small_thumbnail_path = small_thumbnail_path
         self.normal_thumbnail_path = normal_thumbnail_path
         self.large_thumbnail_path = large_thumbnail_path
         self.language_code = language_code
         self.tags = tags
+        self._paths = None # Set by DigitalLibrary.
 
-    def set_documents_dir(self, documents_dir):
-        self._documents_dir = documents_dir
-
-    def set_thumbnails_dir(self, thumbnails_dir):
-        self._thumbnails_dir = thumbnails_dir
+    def set_paths(self, paths):
+        self._paths = paths
 
 
 class DigitalLibrary(object):
@@ -85,6 +120,25 @@ class DigitalLibrary(object):
     THUMBNAIL_SIZE_SMALL = 128
     THUMBNAIL_SIZE_NORMAL = 256
     THUMBNAIL_SIZE_LARGE = 512
+    THUMBNAIL_SIZES = (('small', THUMBNAIL_SIZE_SMALL),
+                       ('normal', THUMBNAIL_SIZE_NORMAL),
+                       ('large', THUMBNAIL_SIZE_LARGE))
+
+    # Methods used to place the documents in the library.
+    # See diglib.core.ingest for the details.
+    PLACEMENT_COPY = ingest.PLACEMENT_COPY
+    PLACEMENT_HARDLINK = ingest.PLACEMENT_HARDLINK
+    PLACEMENT_REFLINK = ingest.PLACEMENT_REFLINK
+    PLACEMENT_SENDFILE = ingest.PLACEMENT_SENDFILE
+    PLACEMENT_MOVE = ingest.PLACEMENT_MOVE
+
+    # Stages of the import of a document.
+    # See diglib.core.ingest for the details.
+    STAGE_STAT = ingest.STAGE_STAT
+    STAGE_MIME = ingest.STAGE_MIME
+    STAGE_HASH = ingest.STAGE_HASH
+    STAGE_CONTENT = ingest.STAGE_CONTENT
+    STAGE_STORE = ingest.STAGE_STORE
 
     # Documents whose similarity is equal or greater
     # than this threshold will be considered equals.
@@ -95,109 +149,301 @@ class DigitalLibrary(object):
     # documents in the database.
     MIN_TERMS = 100
 
-    def __init__(self, library_dir, index_class, database_class):
+    # Maximum number of documents in the cache used by get_doc and get_docs.
+    DOC_CACHE_SIZE = 1000
+
+    # Default commit policy of the index: each modification made outside
+    # a transaction is written to disk before the method returns.
+    INDEX_COMMIT_DOCS = 1
+    INDEX_COMMIT_INTERVAL = None
+
+    # Number of documents fetched at once when the results of a search
+    # (see search_results) are iterated.
+    SEARCH_CHUNK_SIZE = 100
+
+    # Number of documents (per worker process) that add_docs scans ahead of
+    # the ones being extracted.
+    SCAN_AHEAD = 2
+
+    # Maximum number of seconds that add_docs waits for the extraction of a
+    # document by a worker process (e.g. the worker could have been killed).
+    EXTRACTION_TIMEOUT = 600
+
+    # The information of the documents added with add_docs is extracted using
+    # the given number of worker processes (None to use all the CPUs). The
+    # documents are placed in the library using the given method, unless
+    # another one is given when they are added. If defer_thumbnails is True,
+    # the thumbnails of the documents are generated in the background by the
+    # worker processes after the documents are added (see request_thumbnails).
+    # At most doc_cache_size documents are kept in memory by get_doc and
+    # get_docs (0 disables the cache). index_commit_docs and
+    # index_commit_interval set the commit policy of the modifications of
+    # the index made outside transactions (see diglib.core.index). The
+    # operations on several documents always use a single transaction.
+    def __init__(self, library_dir, index_class, database_class, processes=1,
+                 placement=PLACEMENT_COPY, defer_thumbnails=False,
+                 doc_cache_size=DOC_CACHE_SIZE, index_commit_docs=INDEX_COMMIT_DOCS,
+                 index_commit_interval=INDEX_COMMIT_INTERVAL):
         super(DigitalLibrary, self).__init__()
+        if placement not in ingest.PLACEMENTS:
+            raise ValueError('Unknown placement method: %s' % placement)
         if not os.path.isdir(library_dir):
             os.makedirs(library_dir)
-        self._index = index_class(os.path.join(library_dir, 'index'))
+        self._index_class = index_class
+        self._index = index_class(os.path.join(library_dir, 'index'),
+                                  index_commit_docs, index_commit_interval)
         self._database = database_class(os.path.join(library_dir, 'database.db'))
+        self._similarity = SimilarityIndex(os.path.join(library_dir, 'similarity.db'))
+        if self._similarity.get_hash_count() != self._database.get_doc_count():
+            # Missing or out of date (e.g. created by a previous version).
+            hashes = self._database.get_similar_hashes(0, sys.maxint)
+            self._similarity.rebuild([hash_ssdeep for hash_ssdeep, _ in hashes])
+        self._journal = ImportJournal(os.path.join(library_dir, 'imports.db'))
         self._dir_levels = 3
         self._documents_dir = os.path.join(library_dir, 'documents')
         self._thumbnails_dir = os.path.join(library_dir, 'thumbnails')
-        self._magic = magic.open(magic.MAGIC_MIME_TYPE | magic.MAGIC_NO_CHECK_TOKENS)
-        self._magic.load()
-
-    def add_doc(self, doc_path, tags):
+        self._paths = LibraryPaths(self._documents_dir, self._thumbnails_dir)
+        self._processes = processes
+        self._pool = None # Created when needed.
+        self._placement = placement
+        self._defer_thumbnails = defer_thumbnails
+        # Callbacks of the documents whose thumbnails are being generated.
+        self._thumbnails_callbacks = {}
+        self._thumbnails_lock = threading.Lock()
+        # Thumbnails rendered by the pool, written to the library by the
+        # thumbnails thread (created when needed).
+        self._thumbnails_queue = Queue.Queue()
+        self._thumbnails_thread = None
+        self._doc_cache = DocumentCache(doc_cache_size)
+
+    # Add a document to the library. The import goes through the stages defined
+    # in diglib.core.ingest and the document is only copied to the library and
+    # added to the index and the database after all the checks are passed.
+    def add_doc(self, doc_path, tags, placement=None):
         tags = set([self._normalize_tag(tag) for tag in tags])
-        with open(doc_path) as file:
-            doc_data = file.read()
-        # Check if the document is already in the library.
-        doc_size = len(doc_data)
-        hash_md5 = hashlib.md5(doc_data).hexdigest()
-        hash_ssdeep = ssdeep.hash(doc_data)
-        self._check_duplicated(hash_md5, hash_ssdeep, doc_size)
-        # Copy the document to the library.
-        path = ''
-        for i in xrange(self._dir_levels):
-            path = os.path.join(path, hash_md5[:i + 1])
-        path = os.path.join(path, hash_md5)
-        mime_type = self._magic.buffer(doc_data)
-        if mime_type not in self.MIME_TYPES:
-            raise error.DocumentNotSupported()
-        doc_path = path + self.MIME_TYPES[mime_type]
-        doc_abspath = os.path.join(self._documents_dir, doc_path)
-        if not os.path.exists(os.path.dirname(doc_abspath)):
-            os.makedirs(os.path.dirname(doc_abspath))
-        with open(doc_abspath, 'wb') as file:
-            file.write(doc_data)
-        handler = get_handler(doc_abspath, mime_type)
-        # Generate the thumbnails.
-        small_thumbnail_path = None
-        normal_thumbnail_path = None
-        large_thumbnail_path = None
-        for size_name, size in (('small', self.THUMBNAIL_SIZE_SMALL),
-                                ('normal', self.THUMBNAIL_SIZE_NORMAL),
-                                ('large', self.THUMBNAIL_SIZE_LARGE)):
-            thumbnail_data = handler.get_thumbnail(size, size)
-            if thumbnail_data:
-                thumbnail_path = os.path.join(size_name, path + '.png')
-                thumbnail_abspath = os.path.join(self._thumbnails_dir, thumbnail_path)
-                if not os.path.exists(os.path.dirname(thumbnail_abspath)):
-                    os.makedirs(os.path.dirname(thumbnail_abspath))
-                with open(thumbnail_abspath, 'wb') as file:
-                    file.write(thumbnail_data)
-                if size_name == 'small':
-                    small_thumbnail_path = thumbnail_path
-                elif size_name == 'normal':
-                    normal_thumbnail_path = thumbnail_path
-                elif size_name == 'large':
-                    large_thumbnail_path = thumbnail_path
-        # Add the document to the database and the index.
-        content = handler.get_content()
-        metadata = handler.get_metadata()
-        language_code = get_lang(content)
-        doc = Document(hash_md5, hash_ssdeep, mime_type, doc_path,
-                       doc_size, small_thumbnail_path, normal_thumbnail_path,
-                       large_thumbnail_path, language_code, tags)
-        doc.set_documents_dir(self._documents_dir)
-        doc.set_thumbnails_dir(self._thumbnails_dir)
-        self._index.add_doc(doc, content, metadata) # To know the number of terms.
-        # Check if the document can be retrieved with the available information.
-        if not doc.tags and self._index.get_doc_terms_count(doc.hash_md5) < self.MIN_TERMS:
-            self._index.delete_doc(hash_md5)
-            os.remove(doc.document_abspath)
-            if doc.small_thumbnail_abspath:
-                os.remove(doc.small_thumbnail_abspath)
-            if doc.normal_thumbnail_abspath:
-                os.remove(doc.normal_thumbnail_abspath)
-            if doc.large_thumbnail_abspath:
-                os.remove(doc.large_thumbnail_abspath)
-            raise error.DocumentNotRetrievable()
+        placement = placement or self._placement
+        scanned_doc = scan_doc(doc_path, self.MIME_TYPES)
+        self._check_duplicated(scanned_doc, [])
+        extracted_doc = extract_doc(scanned_doc, self._get_thumbnail_sizes(),
+                                    self._index_class, self._get_min_terms(tags))
+        doc = self._add_doc(extracted_doc, tags, placement)
         self._database.add_doc(doc)
+        self._add_similarity_hashes([doc])
+        if placement == self.PLACEMENT_MOVE:
+            os.remove(doc_path)
+        if doc.thumbnails_pending:
+            self._enqueue_thumbnails(doc)
         return doc
 
-    def get_doc(self, hash_md5):
-        doc = self._database.get_doc(hash_md5)
-        if doc:
-            doc.set_documents_dir(self._documents_dir)
-            doc.set_thumbnails_dir(self._thumbnails_dir)
-            return doc
+    # Add several documents to the library. The documents are written to the
+    # index and the database in batches of the given size, one transaction
+    # per batch. Return a list of (doc_path, result) tuples in the same order
+    # as the documents were given, where result is the Document object or the
+    # exception raised while adding the document.
+    #
+    # If the library uses more than one process, the documents are scanned
+    # and extracted by the worker processes while this process looks for
+    # duplicates and writes the extracted documents to the library. Only
+    # the documents that are not duplicated are extracted.
+    def add_docs(self, doc_paths, tags, batch_size=100, placement=None):
+        tags = set([self._normalize_tag(tag) for tag in tags])
+        placement = placement or self._placement
+        scanner = Scanner(self.MIME_TYPES)
+        extractor = Extractor(self._get_thumbnail_sizes(), self._index_class,
+                              self._get_min_terms(tags))
+        if self._processes == 1:
+            pool = None
+            scanned_docs = (scanner(doc_path) for doc_path in doc_paths)
         else:
-            raise error.DocumentNotFound()
+            pool = self._get_pool()
+            scanned_docs = self._scan_docs(pool, scanner, doc_paths)
+        results = []
+        # Documents being extracted, as (position in results, ScannedDoc,
+        # extraction) tuples. The extraction is the ExtractedDoc object, the
+        # exception raised or an AsyncResult from the pool.
+        extractions = collections.deque()
+        for doc_path, scanned_doc in scanned_docs:
+            results.append((doc_path, scanned_doc))
+            if isinstance(scanned_doc, Exception):
+                continue
+            try:
+                pending_docs = [pending_doc for _, pending_doc, _ in extractions]
+                self._check_duplicated(scanned_doc, pending_docs)
+            except error.DocumentError as e:
+                results[-1] = (doc_path, e)
+                continue
+            extraction = (extractor(scanned_doc) if pool is None
+                          else pool.apply_async(extractor, (scanned_doc, )))
+            extractions.append((len(results) - 1, scanned_doc, extraction))
+            if len(extractions) == batch_size:
+                self._add_docs_batch(extractions, results, tags, placement)
+        if extractions:
+            self._add_docs_batch(extractions, results, tags, placement)
+        return results
+
+    # Start importing the files in a directory (and its subdirectories) and
+    # return the identifier of the import job. The files are recorded in the
+    # import journal before any of them is added, so the import can be
+    # continued with resume_import even if the application is closed.
+    def start_import(self, dir_path, tags, placement=None):
+        tags = set([self._normalize_tag(tag) for tag in tags])
+        placement = placement or self._placement
+        job_id = self._journal.add_job(os.path.abspath(dir_path), tags, placement)
+        self.update_import(job_id)
+        return job_id
+
+    # Record in the journal of an import job the files of its directory that
+    # are new or changed since they were recorded (according to their size,
+    # modification time and inode), so they are added by resume_import. The
+    # files are only checked with os.stat. If doc_paths is given only these
+    # files are checked, otherwise the whole directory is walked. The files
+    # modified less than min_age seconds ago are left for a later update
+    # (e.g. they could still be being written). Return the number of files
+    # that were recorded.
+    def update_import(self, job_id, doc_paths=None, min_age=0):
+        job = self.get_import_job(job_id)
+        if doc_paths is None:
+            recorded_stats = self._journal.get_file_stats(job_id)
+            count = 0
+            for dirpath, dirnames, filenames in os.walk(job.dir_path):
+                dirnames.sort()
+                doc_paths = [os.path.join(dirpath, filename)
+                             for filename in sorted(filenames)]
+                count += self._update_import_files(job_id, doc_paths,
+                                                   recorded_stats, min_age)
+            self._journal.set_job_walked(job_id)
+        else:
+            doc_paths = [os.path.abspath(doc_path) for doc_path in doc_paths]
+            recorded_stats = self._journal.get_file_stats(job_id, doc_paths)
+            count = self._update_import_files(job_id, doc_paths,
+                                              recorded_stats, min_age)
+        if count:
+            self._journal.set_job_finished(job_id, False)
+        return count
+
+    # Continue an import job from the first file that was not processed. The
+    # documents are added in batches of the given size and the (doc_path,
+    # result) tuples are generated as in add_docs once each batch is recorded
+    # in the journal. The files that changed after they were processed are
+    # only processed again if they are recorded by update_import.
+    def resume_import(self, job_id, batch_size=100):
+        job = self.get_import_job(job_id)
+        if not job.walked: # Interrupted while walking the directory.
+            self.update_import(job_id)
+        while True:
+            files = self._journal.get_files(job_id, ImportJournal.STATE_PENDING,
+                                            batch_size)
+            if not files:
+                break
+            doc_paths = [doc_path for doc_path, _, _, _ in files]
+            # Seen before the documents are added (they could be moved).
+            file_stats = dict([(doc_path, get_file_stat(doc_path))
+                               for doc_path in doc_paths])
+            try:
+                results = self.add_docs(doc_paths, job.tags, batch_size, job.placement)
+            except Exception as e:
+                results = [(doc_path, e) for doc_path in doc_paths]
+            self._journal.set_states(job_id, [(doc_path, ) + file_stats[doc_path] +
+                                              self._get_import_state(result)
+                                              for doc_path, result in results])
+            for doc_path, result in results:
+                yield doc_path, result
+        self._journal.set_job_finished(job_id)
+
+    def get_import_job(self, job_id):
+        job = self._journal.get_job(job_id)
+        if job is None:
+            raise error.ImportJobNotFound()
+        return job
+
+    # Get the import jobs (optionally only the ones importing the given
+    # directory) that were not finished, or all of them if finished is None.
+    # The most recent jobs are returned first.
+    def get_import_jobs(self, dir_path=None, finished=False):
+        if dir_path is not None:
+            dir_path = os.path.abspath(dir_path)
+        return self._journal.get_jobs(dir_path, finished)
+
+    # Check if an import job adds the documents with the given tags and
+    # placement method (None for the default method of the library).
+    def import_job_matches(self, job_id, tags, placement=None):
+        job = self.get_import_job(job_id)
+        tags = set([self._normalize_tag(tag) for tag in tags])
+        return job.tags == tags and job.placement == (placement or self._placement)
+
+    # Get the number of files processed and the total number of files of an
+    # import job.
+    def get_import_progress(self, job_id):
+        counts = self._journal.get_state_counts(job_id)
+        total = sum(counts.itervalues())
+        return total - counts.get(ImportJournal.STATE_PENDING, 0), total
+
+    def get_doc(self, hash_md5):
+        doc = self._doc_cache.get(hash_md5)
+        if doc is None:
+            generation = self._doc_cache.get_generation()
+            doc = self._database.get_doc(hash_md5)
+            if doc is None:
+                raise error.DocumentNotFound()
+            doc.set_paths(self._paths)
+            self._doc_cache.put([doc], generation)
+        return doc
+
+    # Get the documents with the given hashes, in the same order. Only the
+    # documents that are not cached are fetched from the database.
+    def get_docs(self, hash_list):
+        hash_list = list(hash_list)
+        docs = [self._doc_cache.get(hash_md5) for hash_md5 in hash_list]
+        missing_hashes = [hash_md5 for hash_md5, doc in zip(hash_list, docs) if doc is None]
+        if missing_hashes:
+            generation = self._doc_cache.get_generation()
+            missing_docs = {}
+            for doc in self._database.get_docs(missing_hashes):
+                if doc is None:
+                    raise error.DocumentNotFound()
+                doc.set_paths(self._paths)
+                missing_docs[doc.hash_md5] = doc
+            self._doc_cache.put(missing_docs.values(), generation)
+            docs = [doc if doc is not None else missing_docs[hash_md5]
+                    for hash_md5, doc in zip(hash_list, docs)]
+        return docs
+
+    # Get the number of hits and misses of the cache of documents.
+    def get_doc_cache_stats(self):
+        return self._doc_cache.hits, self._doc_cache.misses
 
     def delete_doc(self, hash_md5):
-        doc = self._database.get_doc(hash_md5)
-        doc.set_documents_dir(self._documents_dir)
-        doc.set_thumbnails_dir(self._thumbnails_dir)
-        os.remove(doc.document_abspath)
-        if doc.small_thumbnail_abspath:
-            os.remove(doc.small_thumbnail_abspath)
-        if doc.normal_thumbnail_abspath:
-            os.remove(doc.normal_thumbnail_abspath)
-        if doc.large_thumbnail_abspath:
-            os.remove(doc.large_thumbnail_abspath)
-        self._database.delete_doc(hash_md5)
-        self._index.delete_doc(hash_md5)
+        self.delete_docs([hash_md5])
+
+    # Delete several documents, using a single transaction of the index and
+    # the database. The files of the documents are removed once they are
+    # no longer in the database.
+    def delete_docs(self, hash_list):
+        hash_list = list(hash_list)
+        docs = self._database.get_docs(hash_list)
+        if None in docs:
+            raise error.DocumentNotFound()
+        with self._index.transaction():
+            for hash_md5 in hash_list:
+                self._index.delete_doc(hash_md5)
+            self._database.delete_docs(hash_list)
+        self._doc_cache.invalidate(hash_list)
+        self._similarity.delete_hashes([doc.hash_ssdeep for doc in docs])
+        for doc in docs:
+            doc.set_paths(self._paths)
+            self._remove_doc_files(doc)
+
+    # Generate the thumbnails of a document in the background if they are
+    # pending. The callback (if given) is called with the updated Document
+    # once the thumbnails are available. Note that the callback is called
+    # from another thread. Return True if the thumbnails are pending.
+    def request_thumbnails(self, hash_md5, callback=None):
+        doc = self.get_doc(hash_md5)
+        if doc.thumbnails_pending:
+            self._enqueue_thumbnails(doc, callback)
+            return True
+        else:
+            return False
 
     def get_doc_count(self):
         return self._database.get_doc_count()
@@ -211,40 +457,342 @@ class DigitalLibrary(object):
     def get_tag_freq(self, tag):
         return self._database.get_tag_freq(tag)
 
+    # Get a dict mapping each tag to the number of documents with the tag.
+    def get_all_tag_counts(self):
+        return self._database.get_all_tag_counts()
+
     def rename_tag(self, old_tag, new_tag):
         old_tag = self._normalize_tag(old_tag)
         new_tag = self._normalize_tag(new_tag)
+        if old_tag == new_tag:
+            return
         self._database.rename_tag(old_tag, new_tag)
+        self._doc_cache.clear()
         self._index.rename_tag(old_tag, new_tag)
 
     def update_tags(self, hash_md5, tags):
+        self.update_tags_bulk({hash_md5: tags})
+
+    # Set the tags of several documents, given as a dict mapping the hash of
+    # each document to its tags, using a single transaction of the index and
+    # the database. No document is modified if one of them would not be
+    # retrievable with its new tags.
+    def update_tags_bulk(self, doc_tags):
+        doc_tags = dict([(hash_md5, set([self._normalize_tag(tag) for tag in tags]))
+                         for hash_md5, tags in doc_tags.iteritems()])
+        for hash_md5, tags in doc_tags.iteritems():
+            if not tags and self._index.get_doc_terms_count(hash_md5) < self.MIN_TERMS:
+                raise error.DocumentNotRetrievable()
+        with self._index.transaction():
+            for hash_md5, tags in doc_tags.iteritems():
+                self._index.update_tags(hash_md5, tags)
+            self._database.update_tags_bulk(doc_tags)
+        self._doc_cache.invalidate(doc_tags.keys())
+
+    # Add the given tags to several documents (see update_tags_bulk).
+    def add_tags(self, hash_list, tags):
         tags = set([self._normalize_tag(tag) for tag in tags])
-        if not tags and self._index.get_doc_terms_count(hash_md5) < self.MIN_TERMS:
-            raise error.DocumentNotRetrievable()
-        else:
-            self._database.update_tags(hash_md5, tags)
-            self._index.update_tags(hash_md5, tags)
+        docs = self.get_docs(hash_list)
+        self.update_tags_bulk(dict([(doc.hash_md5, doc.tags | tags) for doc in docs
+                                    if not tags.issubset(doc.tags)]))
+
+    # Remove the given tags from several documents (see update_tags_bulk).
+    def remove_tags(self, hash_list, tags):
+        tags = set([self._normalize_tag(tag) for tag in tags])
+        docs = self.get_docs(hash_list)
+        self.update_tags_bulk(dict([(doc.hash_md5, doc.tags - tags) for doc in docs
+                                    if not tags.isdisjoint(doc.tags)]))
+
+    # Get the MD5 hashes of the documents with the given tags that match the
+    # query, only in the given languages (codes of diglib.core.lang.LANGUAGES)
+    # if languages is not None.
+    def search(self, query, tags, start=None, count=None, languages=None):
+        tags = set([self._normalize_tag(tag) for tag in tags])
+        return self._index.search(query, tags, start, count, languages)
 
-    def search(self, query, tags, start=None, count=None):
+    # Search the documents like search, returning the results as an object
+    # with estimates of their number (see Index.search_results).
+    def search_results(self, query, tags, languages=None, chunk_size=SEARCH_CHUNK_SIZE):
         tags = set([self._normalize_tag(tag) for tag in tags])
-        return self._index.search(query, tags, start, count)
+        return self._index.search_results(query, tags, languages, chunk_size)
 
+    # The thumbnails being generated are discarded (they are still pending
+    # in the database and they are generated again when requested).
     def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        if self._thumbnails_thread is not None:
+            self._thumbnails_queue.put(None)
+            self._thumbnails_thread.join()
+            self._thumbnails_thread = None
         self._database.close()
+        self._similarity.close()
+        self._journal.close()
         self._index.close()
 
-    # Check if the document (or a similar document) is already in the database.
-    def _check_duplicated(self, hash_md5, hash_ssdeep, doc_size):
-        if self._database.get_doc(hash_md5):
-            raise error.DocumentDuplicatedExact()
-        eps = max(0.5 * doc_size, 102400)
-        lower_size = max(0, doc_size - eps)
-        upper_size = doc_size + eps
-        docs = self._database.get_similar_docs(lower_size, upper_size)
+    # Check if the document is retrievable, copy it to the library and add it
+    # to the index. The document is not added to the database, it should be
+    # done by the caller.
+    def _add_doc(self, extracted_doc, tags, placement):
+        if not tags and extracted_doc.terms_count < self.MIN_TERMS:
+            raise error.DocumentNotRetrievable(stage=self.STAGE_CONTENT)
+        # Copy the document to the library.
+        hash_md5 = extracted_doc.hash_md5
+        path = self._get_path(hash_md5)
+        mime_type = extracted_doc.mime_type
+        doc_path = path + self.MIME_TYPES[mime_type]
+        doc_abspath = os.path.join(self._documents_dir, doc_path)
+        if not os.path.exists(os.path.dirname(doc_abspath)):
+            os.makedirs(os.path.dirname(doc_abspath))
+        place_doc(extracted_doc.doc_path, doc_abspath, placement)
+        # Write the thumbnails.
+        if self._defer_thumbnails:
+            thumbnail_paths = dict([(size_name, Document.THUMBNAIL_PENDING)
+                                    for size_name, _ in self.THUMBNAIL_SIZES])
+        else:
+            thumbnail_paths = self._write_thumbnails(path, extracted_doc.thumbnails)
+        # Add the document to the index.
+        doc = Document(hash_md5, extracted_doc.hash_ssdeep, mime_type, doc_path,
+                       extracted_doc.doc_size, thumbnail_paths.get('small'),
+                       thumbnail_paths.get('normal'), thumbnail_paths.get('large'),
+                       extracted_doc.language_code, tags)
+        doc.set_paths(self._paths)
+        self._index.add_doc(doc, extracted_doc.terms)
+        return doc
+
+    # Scan the documents in the pool and generate the (doc_path, result)
+    # tuples in order. The pool executes the tasks in the order they are
+    # submitted, so only a few documents are scanned ahead. Otherwise the
+    # extractions submitted by add_docs would wait for the scans of all
+    # the documents.
+    def _scan_docs(self, pool, scanner, doc_paths):
+        max_scans = self.SCAN_AHEAD * (self._processes or multiprocessing.cpu_count())
+        scans = collections.deque()
+        for doc_path in doc_paths:
+            scans.append(pool.apply_async(scanner, (doc_path, )))
+            if len(scans) >= max_scans:
+                yield scans.popleft().get()
+        while scans:
+            yield scans.popleft().get()
+
+    # Add the documents being extracted to the library in a single transaction
+    # and set their results. The list of extractions is emptied.
+    def _add_docs_batch(self, extractions, results, tags, placement):
+        docs = []
+        doc_paths = []
+        try:
+            with self._index.transaction():
+                while extractions:
+                    i, scanned_doc, extraction = extractions.popleft()
+                    if isinstance(extraction, multiprocessing.pool.AsyncResult):
+                        try:
+                            extraction = extraction.get(self.EXTRACTION_TIMEOUT)
+                        except multiprocessing.TimeoutError:
+                            extraction = error.DocumentNotRetrievable(
+                                stage=self.STAGE_CONTENT)
+                    doc_path = results[i][0]
+                    if isinstance(extraction, Exception):
+                        results[i] = (doc_path, extraction)
+                        continue
+                    try:
+                        doc = self._add_doc(extraction, tags, placement)
+                    except Exception as e:
+                        results[i] = (doc_path, e)
+                    else:
+                        docs.append(doc)
+                        doc_paths.append(doc_path)
+                        results[i] = (doc_path, doc)
+                self._database.add_docs(docs)
+        except:
+            # Leave the library as it was before the batch (the
+            # transaction of the index was cancelled).
+            for doc in docs:
+                self._remove_doc_files(doc)
+            raise
+        self._add_similarity_hashes(docs)
+        if placement == self.PLACEMENT_MOVE:
+            for doc_path in doc_paths:
+                os.remove(doc_path)
         for doc in docs:
-            score = ssdeep.compare(hash_ssdeep, doc.hash_ssdeep)
+            if doc.thumbnails_pending:
+                self._enqueue_thumbnails(doc)
+
+    # Add the hashes of documents already committed to the similarity index.
+    # A failure is only reported: the documents are in the library and the
+    # similarity index is rebuilt from the database when the library is
+    # opened (the number of hashes does not match).
+    def _add_similarity_hashes(self, docs):
+        try:
+            self._similarity.add_hashes([doc.hash_ssdeep for doc in docs])
+        except Exception:
+            traceback.print_exc()
+
+    # Record the given files of an import job that are not in recorded_stats
+    # or whose (size, mtime, inode) changed as pending. Return their number.
+    def _update_import_files(self, job_id, doc_paths, recorded_stats, min_age):
+        new_files = []
+        changed_files = []
+        max_mtime = time.time() - min_age
+        for doc_path in doc_paths:
+            file_stat = get_file_stat(doc_path)
+            if file_stat[1] is not None and file_stat[1] > max_mtime:
+                continue
+            if doc_path not in recorded_stats:
+                new_files.append((doc_path, ) + file_stat)
+            elif file_stat[0] is not None and file_stat != recorded_stats[doc_path]:
+                changed_files.append((doc_path, ) + file_stat)
+        self._journal.add_files(job_id, new_files)
+        self._journal.reset_files(job_id, changed_files)
+        return len(new_files) + len(changed_files)
+
+    # Return the (state, result) tuple recorded in the import journal
+    # for the result of adding a document with add_docs.
+    def _get_import_state(self, result):
+        if isinstance(result, Document):
+            return ImportJournal.STATE_IMPORTED, result.hash_md5
+        elif isinstance(result, error.DocumentError):
+            return ImportJournal.STATE_REJECTED, type(result).__name__
+        else:
+            return ImportJournal.STATE_FAILED, type(result).__name__
+
+    # Return the path of a document in the library (relative to the documents
+    # or the thumbnails directory and without extension).
+    def _get_path(self, hash_md5):
+        path = ''
+        for i in xrange(self._dir_levels):
+            path = os.path.join(path, hash_md5[:i + 1])
+        path = os.path.join(path, hash_md5)
+        return path
+
+    # The documents without tags are rejected while they are extracted if
+    # they are not retrievable (before their thumbnails are rendered).
+    def _get_min_terms(self, tags):
+        return 0 if tags else self.MIN_TERMS
+
+    def _get_thumbnail_sizes(self):
+        return [] if self._defer_thumbnails \
+            else [size for _, size in self.THUMBNAIL_SIZES]
+
+    # Write the thumbnails given as a dict mapping each size to the PNG data.
+    # Return a dict mapping the name of each size to the path of the thumbnail.
+    # The thumbnails already written are removed if one of them fails.
+    def _write_thumbnails(self, path, thumbnails):
+        thumbnail_paths = {}
+        try:
+            for size_name, size in self.THUMBNAIL_SIZES:
+                thumbnail_data = thumbnails.get(size)
+                if thumbnail_data:
+                    thumbnail_path = os.path.join(size_name, path + '.png')
+                    thumbnail_abspath = os.path.join(self._thumbnails_dir, thumbnail_path)
+                    if not os.path.exists(os.path.dirname(thumbnail_abspath)):
+                        os.makedirs(os.path.dirname(thumbnail_abspath))
+                    thumbnail_paths[size_name] = thumbnail_path
+                    with open(thumbnail_abspath, 'wb') as file:
+                        file.write(thumbnail_data)
+        except:
+            self._remove_thumbnails(thumbnail_paths)
+            raise
+        return thumbnail_paths
+
+    def _remove_thumbnails(self, thumbnail_paths):
+        for thumbnail_path in thumbnail_paths.itervalues():
+            thumbnail_abspath = os.path.join(self._thumbnails_dir, thumbnail_path)
+            if os.path.exists(thumbnail_abspath):
+                os.remove(thumbnail_abspath)
+
+    def _enqueue_thumbnails(self, doc, callback=None):
+        with self._thumbnails_lock:
+            queued = doc.hash_md5 in self._thumbnails_callbacks
+            callbacks = self._thumbnails_callbacks.setdefault(doc.hash_md5, [])
+            if callback is not None:
+                callbacks.append(callback)
+            if self._thumbnails_thread is None:
+                self._thumbnails_thread = threading.Thread(target=self._run_thumbnails_thread)
+                self._thumbnails_thread.daemon = True
+                self._thumbnails_thread.start()
+        if not queued:
+            sizes = [size for _, size in self.THUMBNAIL_SIZES]
+            self._get_pool().apply_async(
+                render_thumbnails, (doc.document_abspath, doc.mime_type, sizes),
+                callback=functools.partial(self._on_thumbnails_rendered, doc.hash_md5))
+
+    # Called in the result handler thread of the pool with the thumbnails
+    # rendered by a worker. They are written by the thumbnails thread, so the
+    # results of the pool (e.g. the extractions of add_docs) are not delayed.
+    def _on_thumbnails_rendered(self, hash_md5, thumbnails):
+        self._thumbnails_queue.put((hash_md5, thumbnails))
+
+    def _run_thumbnails_thread(self):
+        while True:
+            item = self._thumbnails_queue.get()
+            if item is None: # Closed.
+                break
+            self._store_thumbnails(*item)
+
+    # Write the rendered thumbnails of a document and call the callbacks with
+    # the updated document. If the thumbnails could not be rendered (None)
+    # they are left pending and the callbacks are not called.
+    # Exceptions are not propagated because they would stop the thread.
+    def _store_thumbnails(self, hash_md5, thumbnails):
+        doc = None
+        try:
+            if thumbnails is not None:
+                thumbnail_paths = self._write_thumbnails(self._get_path(hash_md5),
+                                                         thumbnails)
+                try:
+                    self._database.update_thumbnails(hash_md5, thumbnail_paths.get('small'),
+                                                     thumbnail_paths.get('normal'),
+                                                     thumbnail_paths.get('large'))
+                except:
+                    self._remove_thumbnails(thumbnail_paths)
+                    raise
+                self._doc_cache.invalidate([hash_md5])
+                doc = self._database.get_doc(hash_md5)
+                if doc:
+                    doc.set_paths(self._paths)
+                else: # The document was deleted in the meantime.
+                    self._remove_thumbnails(thumbnail_paths)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            with self._thumbnails_lock:
+                callbacks = self._thumbnails_callbacks.pop(hash_md5, [])
+        if doc:
+            for callback in callbacks:
+                try:
+                    callback(doc)
+                except Exception:
+                    traceback.print_exc()
+
+    def _remove_doc_files(self, doc):
+        os.remove(doc.document_abspath)
+        if doc.small_thumbnail_abspath:
+            os.remove(doc.small_thumbnail_abspath)
+        if doc.normal_thumbnail_abspath:
+            os.remove(doc.normal_thumbnail_abspath)
+        if doc.large_thumbnail_abspath:
+            os.remove(doc.large_thumbnail_abspath)
+
+    # Check if the scanned document (or a similar document) is already in the
+    # database or in the list of documents pending to be added to the
+    # database. Only the candidates given by the similarity index are compared.
+    def _check_duplicated(self, scanned_doc, pending_docs):
+        if (self._database.get_doc(scanned_doc.hash_md5) or
+            any(doc.hash_md5 == scanned_doc.hash_md5 for doc in pending_docs)):
+            raise error.DocumentDuplicatedExact(stage=self.STAGE_HASH)
+        candidates = self._similarity.get_candidates(scanned_doc.hash_ssdeep)
+        candidates.extend([doc.hash_ssdeep for doc in pending_docs])
+        for hash_ssdeep in candidates:
+            score = ssdeep.compare(scanned_doc.hash_ssdeep, hash_ssdeep)
             if score >= self.SSDEEP_THRESHOLD:
-                raise error.DocumentDuplicatedSimilar()
+                raise error.DocumentDuplicatedSimilar(stage=self.STAGE_HASH)
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self._processes)
+        return self._pool
 
     def _normalize_tag(self, tag):
         tag = tag.strip().lower()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+#
+# diglib: Personal digital document management software.
+# Copyright (C) 2011-2015 Yasser Gonzalez <yasserglez@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import copy
+import threading
+import collections
+
+
+# Least recently used cache of Document objects, indexed by their MD5 hash.
+# The documents are copied when they are added and returned, so the callers
+# can modify them (e.g. their tags) without modifying the cached ones.
+#
+# A document read from the database before it was invalidated could be added
+# after the invalidation. To avoid it, the callers get the generation of the
+# cache before reading the documents and pass it to put, which ignores the
+# documents if there was any invalidation in the meantime.
+
+class DocumentCache(object):
+
+    def __init__(self, max_size):
+        super(DocumentCache, self).__init__()
+        self._max_size = max_size
+        self._docs = collections.OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._docs)
+
+    def get_generation(self):
+        with self._lock:
+            return self._generation
+
+    # Return a copy of the cached document or None if it is not cached.
+    def get(self, hash_md5):
+        with self._lock:
+            doc = self._docs.pop(hash_md5, None)
+            if doc is None:
+                self.misses += 1
+                return None
+            self._docs[hash_md5] = doc # Most recently used.
+            self.hits += 1
+        return _copy_doc(doc)
+
+    def put(self, docs, generation):
+        if self._max_size <= 0:
+            return
+        docs = [_copy_doc(doc) for doc in docs]
+        with self._lock:
+            if generation != self._generation:
+                return # Invalidated while the documents were read.
+            for doc in docs:
+                self._docs.pop(doc.hash_md5, None)
+                self._docs[doc.hash_md5] = doc
+            while len(self._docs) > self._max_size:
+                self._docs.popitem(last=False)
+
+    def invalidate(self, hash_list):
+        with self._lock:
+            self._generation += 1
+            for hash_md5 in hash_list:
+                self._docs.pop(hash_md5, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._docs.clear()
+
+
+def _copy_doc(doc):
+    doc = copy.copy(doc)
+    doc.tags = set(doc.tags)
+    return doc
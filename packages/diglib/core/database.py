@@ -16,8 +16,14 @@
 # You should have received a copy of the GNU General Public License along
 # with this program. If not, see <http://www.gnu.org/licenses/>.
 
-from sqlalchemy import create_engine, Table, Column, Integer, String, ForeignKey
-from sqlalchemy.orm import sessionmaker, relationship
+import sqlite3
+import threading
+import contextlib
+
+from sqlalchemy import create_engine, event, func, select, bindparam, \
+    Table, Column, Integer, String, ForeignKey
+from sqlalchemy.orm import sessionmaker, scoped_session, relationship
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.ext.declarative import declarative_base
 
 from diglib.core import Document
@@ -31,16 +37,35 @@ class Database(object):
     def add_doc(self, doc):
         raise NotImplementedError()
 
+    # Add several documents in a single transaction.
+    def add_docs(self, docs):
+        raise NotImplementedError()
+
     def get_doc(self, hash_md5):
         raise NotImplementedError()
 
-    # Get documents whose size is between the given values.
-    def get_similar_docs(self, lower_size, upper_size):
+    # Get the documents with the given hashes, in the same order. The list
+    # contains None in the place of the documents that were not found.
+    def get_docs(self, hash_list):
+        raise NotImplementedError()
+
+    # Get the (hash_ssdeep, document_size) tuples of the documents
+    # whose size is between the given values.
+    def get_similar_hashes(self, lower_size, upper_size):
         raise NotImplementedError()
 
     def delete_doc(self, hash_md5):
         raise NotImplementedError()
 
+    # Delete several documents in a single transaction.
+    def delete_docs(self, hash_list):
+        raise NotImplementedError()
+
+    # Set the paths of the thumbnails of a document.
+    def update_thumbnails(self, hash_md5, small_thumbnail_path,
+                          normal_thumbnail_path, large_thumbnail_path):
+        raise NotImplementedError()
+
     # Get all tags in the database.
     def get_all_tags(self):
         raise NotImplementedError()
@@ -49,16 +74,88 @@ class Database(object):
     def get_tag_freq(self, tag):
         raise NotImplementedError()
 
+    # Get a dict mapping each tag to the number of documents with the tag.
+    def get_all_tag_counts(self):
+        raise NotImplementedError()
+
     def rename_tag(self, old_tag, new_tag):
         raise NotImplementedError()
 
     def update_tags(self, hash_md5, new_tags):
         raise NotImplementedError()
 
+    # Set the tags of several documents in a single transaction. The
+    # argument is a dict mapping the hash of each document to its tags.
+    def update_tags_bulk(self, doc_tags):
+        raise NotImplementedError()
+
     def close(self):
         raise NotImplementedError()
 
 
+# Pragmas set on each connection to the SQLite database. The WAL journal
+# allows reading while the database is being written and, with synchronous
+# set to NORMAL, the transactions are only synced to disk at the checkpoints
+# (a committed transaction could be lost if the system crashes, but the
+# database is not corrupted). cache_size is given in KiB (negative) and
+# mmap_size in bytes.
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', -16384),
+    ('mmap_size', 268435456),
+)
+
+# Maximum number of values in an IN clause (SQLite
+# allows at most 999 parameters in a statement).
+SQLITE_MAX_IN_VALUES = 500
+
+# Changes of the schema of the SQLite databases created by previous versions,
+# in order. The user_version pragma of a database is the number of changes
+# applied to it. The tables are created by each Database class.
+SQLITE_MIGRATIONS = (
+    # Indexes used by get_similar_hashes and the tag queries.
+    '''
+    CREATE INDEX IF NOT EXISTS documents_document_size ON documents (document_size);
+    CREATE INDEX IF NOT EXISTS document_tags_document_id ON document_tags (document_id);
+    CREATE INDEX IF NOT EXISTS document_tags_tag_id ON document_tags (tag_id);
+    ''',
+    # Index used to delete the link of a tag to a document (the index on
+    # tag_id was used otherwise, scanning all the documents with the tag).
+    '''
+    CREATE INDEX IF NOT EXISTS document_tags_document_id_tag_id
+        ON document_tags (document_id, tag_id);
+    DROP INDEX IF EXISTS document_tags_document_id;
+    ''',
+)
+
+
+# Apply the pending changes of SQLITE_MIGRATIONS using a sqlite3 connection.
+def _migrate_sqlite_schema(conn):
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for version, script in enumerate(SQLITE_MIGRATIONS[version:], version + 1):
+        # Each change is applied in a transaction with the new version.
+        conn.executescript('BEGIN; %s PRAGMA user_version = %d; COMMIT;' %
+                           (script, version))
+
+
+# Compare the new tags of the documents (doc_tags maps their hashes to
+# their tags) with the tags in the database (old_doc_tags maps the ids of
+# the documents to dicts mapping their tags to the ids of the tags). Return
+# the (document_id, tag_id) links to delete and the (document_id, tag)
+# links to add.
+def _diff_doc_tags(doc_tags, document_ids, old_doc_tags):
+    removed_links = []
+    added_links = []
+    for hash_md5, document_id in document_ids.iteritems():
+        new_tags = doc_tags[hash_md5]
+        old_tags = old_doc_tags[document_id]
+        removed_links.extend([(document_id, tag_id) for tag, tag_id in old_tags.iteritems()
+                              if tag not in new_tags])
+        added_links.extend([(document_id, tag) for tag in new_tags if tag not in old_tags])
+    return removed_links, added_links
+
+
 # Implementation of a SQLite database managed by SQLAchemy.
 
 SQLAlchemyBase = declarative_base()
@@ -111,138 +208,299 @@ document_tags = Table('document_tags', SQLAlchemyBase.metadata,
 
 class SQLAlchemyDatabase(Database):
 
+    # Number of connections kept open by the pool.
+    POOL_SIZE = 5
+
     def __init__(self, database_file):
         super(SQLAlchemyDatabase, self).__init__(database_file)
-        engine = create_engine('sqlite:///%s' % database_file)
-        SQLAlchemyBase.metadata.create_all(engine)
-        self._sessionmaker = sessionmaker(engine)
+        # The connections (and the prepared statements cached by sqlite3) are
+        # kept open while the database is open. Each method checks out a
+        # connection only while its session is open, so the connections are
+        # shared by the threads (e.g. the GUI, the result handler of the pool
+        # and the directory watcher). If more sessions are open at the same
+        # time, the extra connections are opened without waiting and closed
+        # when they are returned, never while they are being used.
+        self._engine = create_engine('sqlite:///%s' % database_file,
+                                     poolclass=QueuePool, pool_size=self.POOL_SIZE,
+                                     max_overflow=-1,
+                                     connect_args={'check_same_thread': False})
+        event.listen(self._engine, 'connect', self._set_pragmas)
+        SQLAlchemyBase.metadata.create_all(self._engine)
+        connection = self._engine.raw_connection()
+        try:
+            _migrate_sqlite_schema(connection.connection)
+        finally:
+            connection.close()
+        self._session = scoped_session(sessionmaker(self._engine))
+        # Statements compiled once, used in the most frequent lookups.
+        self._compiled_cache = {}
+        documents = SQLAlchemyDocument.__table__
+        tags = SQLAlchemyTag.__table__
+        self._get_doc_query = select([documents]) \
+            .where(documents.c.hash_md5 == bindparam('hash_md5'))
+        self._get_doc_tags_query = select([tags.c.name]) \
+            .select_from(tags.join(document_tags, tags.c.id == document_tags.c.tag_id)) \
+            .where(document_tags.c.document_id == bindparam('document_id'))
+        self._get_doc_count_query = select([func.count(documents.c.id)])
+        self._get_tag_count_query = select([func.count(document_tags.c.document_id)]) \
+            .select_from(document_tags.join(tags, tags.c.id == document_tags.c.tag_id)) \
+            .where(tags.c.name == bindparam('name'))
+        self._get_similar_hashes_query = \
+            select([documents.c.hash_ssdeep, documents.c.document_size]) \
+            .where(documents.c.document_size >= bindparam('lower_size')) \
+            .where(documents.c.document_size <= bindparam('upper_size'))
+        self._get_all_tags_query = select([tags.c.name])
+        self._get_all_tag_counts_query = \
+            select([tags.c.name, func.count(document_tags.c.document_id)]) \
+            .select_from(tags.outerjoin(document_tags, tags.c.id == document_tags.c.tag_id)) \
+            .group_by(tags.c.id)
 
     def add_doc(self, doc):
-        session = self._sessionmaker()
-        sqlalchemy_tags =  self._normalize_tags(session, doc.tags)
-        sqlalchemy_doc = \
-            SQLAlchemyDocument(doc.hash_md5, doc.hash_ssdeep, doc.mime_type,
-                               doc.document_path, doc.document_size,
-                               doc.small_thumbnail_path, doc.normal_thumbnail_path,
-                               doc.large_thumbnail_path, doc.language_code,
-                               sqlalchemy_tags)
-        session.add(sqlalchemy_doc)
-        session.commit()
-        session.close()
+        self.add_docs([doc])
+
+    def add_docs(self, docs):
+        with self._get_session() as session:
+            for doc in docs:
+                sqlalchemy_tags =  self._normalize_tags(session, doc.tags)
+                sqlalchemy_doc = \
+                    SQLAlchemyDocument(doc.hash_md5, doc.hash_ssdeep, doc.mime_type,
+                                       doc.document_path, doc.document_size,
+                                       doc.small_thumbnail_path, doc.normal_thumbnail_path,
+                                       doc.large_thumbnail_path, doc.language_code,
+                                       sqlalchemy_tags)
+                session.add(sqlalchemy_doc)
+            session.commit()
 
     def get_doc(self, hash_md5):
-        session = self._sessionmaker()
-        sqlalchemy_doc = session.query(SQLAlchemyDocument) \
-            .filter_by(hash_md5=hash_md5).scalar()
-        if sqlalchemy_doc:
-            tags = set([sqlalchemy_tag.name for sqlalchemy_tag in sqlalchemy_doc.tags])
-            doc = Document(sqlalchemy_doc.hash_md5, sqlalchemy_doc.hash_ssdeep,
-                           sqlalchemy_doc.mime_type, sqlalchemy_doc.document_path,
-                           sqlalchemy_doc.document_size,
-                           sqlalchemy_doc.small_thumbnail_path,
-                           sqlalchemy_doc.normal_thumbnail_path,
-                           sqlalchemy_doc.large_thumbnail_path,
-                           sqlalchemy_doc.language_code, tags)
-        else:
-            doc = None # Document not found.
-        session.close()
+        with self._get_session() as session:
+            row = self._execute(session, self._get_doc_query, hash_md5=hash_md5).first()
+            if row:
+                tags = set([tag_row[0] for tag_row in
+                            self._execute(session, self._get_doc_tags_query,
+                                          document_id=row.id)])
+                doc = self._create_doc(row, tags)
+            else:
+                doc = None # Document not found.
         return doc
 
-    def get_similar_docs(self, lower_size, upper_size):
-        docs = []
-        session = self._sessionmaker()
-        query = session.query(SQLAlchemyDocument) \
-            .filter(SQLAlchemyDocument.document_size >= lower_size) \
-            .filter(SQLAlchemyDocument.document_size <= upper_size)
-        for sqlalchemy_doc in query.all():
-            tags = set([sqlalchemy_tag.name for sqlalchemy_tag in sqlalchemy_doc.tags])
-            doc = Document(sqlalchemy_doc.hash_md5, sqlalchemy_doc.hash_ssdeep,
-                           sqlalchemy_doc.mime_type, sqlalchemy_doc.document_path,
-                           sqlalchemy_doc.document_size,
-                           sqlalchemy_doc.small_thumbnail_path,
-                           sqlalchemy_doc.normal_thumbnail_path,
-                           sqlalchemy_doc.large_thumbnail_path,
-                           sqlalchemy_doc.language_code, tags)
-            docs.append(doc)
-        session.close()
-        return docs
+    # The documents are fetched with two queries (the documents and
+    # their tags) for each group of SQLITE_MAX_IN_VALUES hashes.
+    def get_docs(self, hash_list):
+        documents = SQLAlchemyDocument.__table__
+        tags = SQLAlchemyTag.__table__
+        docs = {}
+        with self._get_session() as session:
+            for i in xrange(0, len(hash_list), SQLITE_MAX_IN_VALUES):
+                hash_chunk = hash_list[i:i + SQLITE_MAX_IN_VALUES]
+                query = select([documents]).where(documents.c.hash_md5.in_(hash_chunk))
+                rows = session.execute(query).fetchall()
+                if not rows:
+                    continue
+                doc_tags = dict([(row.id, set()) for row in rows])
+                query = select([document_tags.c.document_id, tags.c.name]) \
+                    .select_from(tags.join(document_tags, tags.c.id == document_tags.c.tag_id)) \
+                    .where(document_tags.c.document_id.in_(doc_tags.keys()))
+                for document_id, tag in session.execute(query):
+                    doc_tags[document_id].add(tag)
+                for row in rows:
+                    docs[row.hash_md5] = self._create_doc(row, doc_tags[row.id])
+        return [docs.get(hash_md5) for hash_md5 in hash_list]
+
+    def get_similar_hashes(self, lower_size, upper_size):
+        with self._get_session() as session:
+            return [tuple(row) for row in
+                    self._execute(session, self._get_similar_hashes_query,
+                                  lower_size=lower_size, upper_size=upper_size)]
 
     def delete_doc(self, hash_md5):
-        session = self._sessionmaker()
-        sqlalchemy_doc = session.query(SQLAlchemyDocument) \
-            .filter_by(hash_md5=hash_md5).scalar()
-        if sqlalchemy_doc:
-            for tag in [sqlalchemy_tag.name for sqlalchemy_tag in sqlalchemy_doc.tags]:
-                if self.get_tag_count(tag) == 1:
-                    sqlalchemy_tag = self._normalize_tag(session, tag)
-                    session.delete(sqlalchemy_tag)
-            session.delete(sqlalchemy_doc)
+        self.delete_docs([hash_md5])
+
+    def delete_docs(self, hash_list):
+        documents = SQLAlchemyDocument.__table__
+        with self._get_session() as session:
+            document_ids = self._get_document_ids(session, hash_list).values()
+            tag_ids = set()
+            for i in xrange(0, len(document_ids), SQLITE_MAX_IN_VALUES):
+                ids_chunk = document_ids[i:i + SQLITE_MAX_IN_VALUES]
+                query = select([document_tags.c.tag_id]) \
+                    .where(document_tags.c.document_id.in_(ids_chunk))
+                tag_ids.update([row[0] for row in session.execute(query)])
+                session.execute(document_tags.delete()
+                                .where(document_tags.c.document_id.in_(ids_chunk)))
+                session.execute(documents.delete().where(documents.c.id.in_(ids_chunk)))
+            self._delete_orphan_tags(session, list(tag_ids))
             session.commit()
-        session.close()
+
+    def update_thumbnails(self, hash_md5, small_thumbnail_path,
+                          normal_thumbnail_path, large_thumbnail_path):
+        with self._get_session() as session:
+            sqlalchemy_doc = session.query(SQLAlchemyDocument) \
+                .filter_by(hash_md5=hash_md5).scalar()
+            if sqlalchemy_doc:
+                sqlalchemy_doc.small_thumbnail_path = small_thumbnail_path
+                sqlalchemy_doc.normal_thumbnail_path = normal_thumbnail_path
+                sqlalchemy_doc.large_thumbnail_path = large_thumbnail_path
+                session.commit()
 
     def get_all_tags(self):
-        tags = set()
-        session = self._sessionmaker()
-        query = session.query(SQLAlchemyTag)
-        for sqlalchemy_tag in query.all():
-            tags.add(sqlalchemy_tag.name)
-        session.close()
-        return tags
+        with self._get_session() as session:
+            return set([row[0] for row in self._execute(session, self._get_all_tags_query)])
 
     def get_doc_count(self):
-        session = self._sessionmaker()
-        doc_count = session.query(SQLAlchemyDocument).count()
-        return doc_count
+        with self._get_session() as session:
+            return self._get_doc_count(session)
 
     def get_tag_count(self, tag):
-        session = self._sessionmaker()
-        query = session.query(SQLAlchemyTag).filter_by(name=tag)
-        sqlalchemy_tag = query.scalar()
-        tag_count = len(sqlalchemy_tag.documents) if sqlalchemy_tag else 0
-        return tag_count
+        with self._get_session() as session:
+            return self._get_tag_count(session, tag)
 
     def get_tag_freq(self, tag):
-        doc_count = self.get_doc_count()
-        if doc_count:
-            tag_count = self.get_tag_count(tag)
-            return tag_count / float(doc_count)
-        else:
-            return 0.0
+        with self._get_session() as session:
+            return self._get_tag_freq(session, tag)
+
+    def get_all_tag_counts(self):
+        with self._get_session() as session:
+            return dict(list(self._execute(session, self._get_all_tag_counts_query)))
 
     def rename_tag(self, old_tag, new_tag):
-        session = self._sessionmaker()
-        old_sqlalchemy_tag = session.query(SQLAlchemyTag) \
-            .filter_by(name=old_tag).scalar()
-        new_sqlalchemy_tag = session.query(SQLAlchemyTag) \
-            .filter_by(name=new_tag).scalar()
-        if new_sqlalchemy_tag:
-            for sqlalchemy_doc in old_sqlalchemy_tag.documents:
-                i = sqlalchemy_doc.tags.index(old_sqlalchemy_tag)
-                sqlalchemy_doc.tags[i] = new_sqlalchemy_tag
-            session.delete(old_sqlalchemy_tag)
-        else:
-            old_sqlalchemy_tag.name = new_tag
-        session.commit()
-        session.close()
+        tags = SQLAlchemyTag.__table__
+        with self._get_session() as session:
+            old_tag_id = self._get_tag_id(session, old_tag)
+            new_tag_id = self._get_tag_id(session, new_tag)
+            if old_tag_id == new_tag_id:
+                return # The same tag (or none of them exists).
+            if old_tag_id is not None and new_tag_id is not None:
+                # Merge the tags (without duplicating the tag of a document).
+                tagged_ids = select([document_tags.c.document_id]) \
+                    .where(document_tags.c.tag_id == new_tag_id)
+                session.execute(document_tags.update()
+                                .where(document_tags.c.tag_id == old_tag_id)
+                                .where(~document_tags.c.document_id.in_(tagged_ids))
+                                .values(tag_id=new_tag_id))
+                session.execute(document_tags.delete()
+                                .where(document_tags.c.tag_id == old_tag_id))
+                session.execute(tags.delete().where(tags.c.id == old_tag_id))
+            elif old_tag_id is not None:
+                session.execute(tags.update().where(tags.c.id == old_tag_id)
+                                .values(name=new_tag))
+            session.commit()
 
     def update_tags(self, hash_md5, new_tags):
-        session = self._sessionmaker()
-        sqlalchemy_doc = session.query(SQLAlchemyDocument) \
-            .filter_by(hash_md5=hash_md5).scalar()
-        if sqlalchemy_doc:
-            old_tags = set([sqlalchemy_tag.name for sqlalchemy_tag in sqlalchemy_doc.tags])
-            removed_tags = old_tags.difference(new_tags)
-            sqlalchemy_doc.tags = self._normalize_tags(session, new_tags)
+        self.update_tags_bulk({hash_md5: new_tags})
+
+    # Only the links of the tags that were removed from or added to
+    # each document are deleted or inserted.
+    def update_tags_bulk(self, doc_tags):
+        tags = SQLAlchemyTag.__table__
+        with self._get_session() as session:
+            document_ids = self._get_document_ids(session, doc_tags.keys())
+            old_doc_tags = dict([(document_id, {}) for document_id in document_ids.itervalues()])
+            ids = old_doc_tags.keys()
+            for i in xrange(0, len(ids), SQLITE_MAX_IN_VALUES):
+                query = select([document_tags.c.document_id, tags.c.name, tags.c.id]) \
+                    .select_from(tags.join(document_tags, tags.c.id == document_tags.c.tag_id)) \
+                    .where(document_tags.c.document_id.in_(ids[i:i + SQLITE_MAX_IN_VALUES]))
+                for document_id, name, tag_id in session.execute(query):
+                    old_doc_tags[document_id][name] = tag_id
+            removed_links, added_links = \
+                _diff_doc_tags(doc_tags, document_ids, old_doc_tags)
+            if removed_links:
+                session.execute(document_tags.delete()
+                                .where(document_tags.c.document_id == bindparam('document_id'))
+                                .where(document_tags.c.tag_id == bindparam('tag_id')),
+                                [{'document_id': document_id, 'tag_id': tag_id}
+                                 for document_id, tag_id in removed_links])
+            self._add_doc_tags(session, added_links)
+            self._delete_orphan_tags(session, list(set([tag_id for _, tag_id in removed_links])))
             session.commit()
-        for tag in removed_tags:
-            if not self.get_tag_freq(tag):
-                sqlalchemy_tag = self._normalize_tag(session, tag)
-                session.delete(sqlalchemy_tag)
-                session.commit()
-        session.close()
 
     def close(self):
-        self._sessionmaker.close_all()
+        self._session.remove()
+        self._engine.dispose()
+
+    # Return a session of the current thread, closed (and its transaction
+    # rolled back if it was not committed) when the block is exited.
+    @contextlib.contextmanager
+    def _get_session(self):
+        session = self._session()
+        try:
+            yield session
+        finally:
+            session.close()
+
+    # Execute one of the compiled statements using the connection of the session.
+    def _execute(self, session, statement, **params):
+        connection = session.connection() \
+            .execution_options(compiled_cache=self._compiled_cache)
+        return connection.execute(statement, **params)
+
+    # Get a dict mapping the hashes of the documents found in
+    # the database to the ids of the documents.
+    def _get_document_ids(self, session, hash_list):
+        documents = SQLAlchemyDocument.__table__
+        hash_list = list(hash_list)
+        document_ids = {}
+        for i in xrange(0, len(hash_list), SQLITE_MAX_IN_VALUES):
+            hash_chunk = hash_list[i:i + SQLITE_MAX_IN_VALUES]
+            query = select([documents.c.hash_md5, documents.c.id]) \
+                .where(documents.c.hash_md5.in_(hash_chunk))
+            document_ids.update(list(session.execute(query)))
+        return document_ids
+
+    def _get_tag_id(self, session, tag):
+        tags = SQLAlchemyTag.__table__
+        return session.execute(select([tags.c.id]).where(tags.c.name == tag)).scalar()
+
+    # Add the (document_id, tag) links, adding the tags that are not in the database.
+    def _add_doc_tags(self, session, links):
+        if not links:
+            return
+        tags = SQLAlchemyTag.__table__
+        session.execute(tags.insert().prefix_with('OR IGNORE'),
+                        [{'name': tag} for tag in set([tag for _, tag in links])])
+        query = select([bindparam('document_id', type_=Integer), tags.c.id]) \
+            .where(tags.c.name == bindparam('name'))
+        session.execute(document_tags.insert().from_select(['document_id', 'tag_id'], query),
+                        [{'document_id': document_id, 'name': tag}
+                         for document_id, tag in links])
+
+    # Delete the tags with the given ids that are not used by any document.
+    def _delete_orphan_tags(self, session, tag_ids):
+        tags = SQLAlchemyTag.__table__
+        for i in xrange(0, len(tag_ids), SQLITE_MAX_IN_VALUES):
+            tag_ids_chunk = tag_ids[i:i + SQLITE_MAX_IN_VALUES]
+            used_tag_ids = select([document_tags.c.tag_id]) \
+                .where(document_tags.c.tag_id.in_(tag_ids_chunk))
+            session.execute(tags.delete()
+                            .where(tags.c.id.in_(tag_ids_chunk))
+                            .where(~tags.c.id.in_(used_tag_ids)))
+
+    # Create a Document from a row of the documents table.
+    def _create_doc(self, row, tags):
+        return Document(row.hash_md5, row.hash_ssdeep, row.mime_type,
+                        row.document_path, row.document_size,
+                        row.small_thumbnail_path, row.normal_thumbnail_path,
+                        row.large_thumbnail_path, row.language_code, tags)
+
+    def _get_doc_count(self, session):
+        return self._execute(session, self._get_doc_count_query).scalar()
+
+    def _get_tag_count(self, session, tag):
+        return self._execute(session, self._get_tag_count_query, name=tag).scalar()
+
+    def _get_tag_freq(self, session, tag):
+        doc_count = self._get_doc_count(session)
+        if doc_count:
+            tag_count = self._get_tag_count(session, tag)
+            return tag_count / float(doc_count)
+        else:
+            return 0.0
+
+    def _set_pragmas(self, dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in SQLITE_PRAGMAS:
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
 
     # Return a SQLAlchemyTag corresponding to the given tag name.
     # The tag is added if it does not exists in the database.
@@ -252,7 +510,7 @@ class SQLAlchemyDatabase(Database):
         if not sqlalchemy_tag: # Tag does not exists.
             sqlalchemy_tag = SQLAlchemyTag(tag)
             session.add(sqlalchemy_tag)
-            session.commit()
+            session.flush() # Committed with the rest of the transaction.
         return sqlalchemy_tag
 
     def _normalize_tags(self, session, tags):
@@ -261,3 +519,251 @@ class SQLAlchemyDatabase(Database):
             sqlalchemy_tag = self._normalize_tag(session, tag)
             sqlalchemy_tags.append(sqlalchemy_tag)
         return sqlalchemy_tags
+
+
+# Implementation of a SQLite database using the sqlite3 module directly. The
+# database has the same tables as the one of SQLAlchemyDatabase, so a library
+# can be opened with both classes.
+
+class SQLiteDatabase(Database):
+
+    # Columns of the documents table in the order of the Document arguments.
+    DOCUMENT_COLUMNS = ('hash_md5', 'hash_ssdeep', 'mime_type', 'document_path',
+                        'document_size', 'small_thumbnail_path', 'normal_thumbnail_path',
+                        'large_thumbnail_path', 'language_code')
+
+    def __init__(self, database_file):
+        super(SQLiteDatabase, self).__init__(database_file)
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(database_file, check_same_thread=False)
+        for name, value in SQLITE_PRAGMAS:
+            self._conn.execute('PRAGMA %s = %s' % (name, value))
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS tags (
+                id INTEGER NOT NULL PRIMARY KEY,
+                name VARCHAR NOT NULL UNIQUE
+            );
+            CREATE TABLE IF NOT EXISTS documents (
+                id INTEGER NOT NULL PRIMARY KEY,
+                hash_md5 VARCHAR NOT NULL UNIQUE,
+                hash_ssdeep VARCHAR NOT NULL UNIQUE,
+                mime_type VARCHAR NOT NULL,
+                document_path VARCHAR NOT NULL,
+                document_size INTEGER NOT NULL,
+                small_thumbnail_path VARCHAR,
+                normal_thumbnail_path VARCHAR,
+                large_thumbnail_path VARCHAR,
+                language_code VARCHAR NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS document_tags (
+                document_id INTEGER REFERENCES documents (id),
+                tag_id INTEGER REFERENCES tags (id)
+            );
+        ''')
+        self._conn.commit()
+        _migrate_sqlite_schema(self._conn)
+        self._select_docs = 'SELECT id, %s FROM documents' % ', '.join(self.DOCUMENT_COLUMNS)
+
+    def add_doc(self, doc):
+        self.add_docs([doc])
+
+    def add_docs(self, docs):
+        with self._transaction():
+            links = []
+            for doc in docs:
+                cursor = self._conn.execute(
+                    'INSERT INTO documents (%s) VALUES (%s)' %
+                    (', '.join(self.DOCUMENT_COLUMNS), ', '.join('?' * len(self.DOCUMENT_COLUMNS))),
+                    [getattr(doc, column) for column in self.DOCUMENT_COLUMNS])
+                links.extend([(cursor.lastrowid, tag) for tag in doc.tags])
+            self._add_doc_tags(links)
+
+    def get_doc(self, hash_md5):
+        docs = self.get_docs([hash_md5])
+        return docs[0]
+
+    # The documents are fetched with two queries (the documents and
+    # their tags) for each group of SQLITE_MAX_IN_VALUES hashes.
+    def get_docs(self, hash_list):
+        docs = {}
+        with self._lock:
+            for i in xrange(0, len(hash_list), SQLITE_MAX_IN_VALUES):
+                hash_chunk = hash_list[i:i + SQLITE_MAX_IN_VALUES]
+                rows = self._conn.execute(
+                    '%s WHERE hash_md5 IN (%s)' %
+                    (self._select_docs, ', '.join('?' * len(hash_chunk))),
+                    hash_chunk).fetchall()
+                for doc in self._create_docs(rows):
+                    docs[doc.hash_md5] = doc
+        return [docs.get(hash_md5) for hash_md5 in hash_list]
+
+    def get_similar_hashes(self, lower_size, upper_size):
+        with self._lock:
+            return self._conn.execute(
+                'SELECT hash_ssdeep, document_size FROM documents '
+                'WHERE document_size >= ? AND document_size <= ?',
+                (lower_size, upper_size)).fetchall()
+
+    def delete_doc(self, hash_md5):
+        self.delete_docs([hash_md5])
+
+    def delete_docs(self, hash_list):
+        with self._transaction():
+            document_ids = self._get_document_ids(hash_list).values()
+            tag_ids = set()
+            for i in xrange(0, len(document_ids), SQLITE_MAX_IN_VALUES):
+                ids_chunk = document_ids[i:i + SQLITE_MAX_IN_VALUES]
+                in_ids = ', '.join('?' * len(ids_chunk))
+                tag_ids.update([row[0] for row in self._conn.execute(
+                    'SELECT tag_id FROM document_tags WHERE document_id IN (%s)' % in_ids,
+                    ids_chunk)])
+                self._conn.execute('DELETE FROM document_tags WHERE document_id IN (%s)' %
+                                   in_ids, ids_chunk)
+                self._conn.execute('DELETE FROM documents WHERE id IN (%s)' % in_ids, ids_chunk)
+            self._delete_orphan_tags(list(tag_ids))
+
+    def update_thumbnails(self, hash_md5, small_thumbnail_path,
+                          normal_thumbnail_path, large_thumbnail_path):
+        with self._transaction():
+            self._conn.execute(
+                'UPDATE documents SET small_thumbnail_path = ?, normal_thumbnail_path = ?, '
+                'large_thumbnail_path = ? WHERE hash_md5 = ?',
+                (small_thumbnail_path, normal_thumbnail_path, large_thumbnail_path, hash_md5))
+
+    def get_all_tags(self):
+        with self._lock:
+            return set([row[0] for row in self._conn.execute('SELECT name FROM tags')])
+
+    def get_doc_count(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM documents').fetchone()[0]
+
+    def get_tag_count(self, tag):
+        with self._lock:
+            return self._conn.execute(
+                'SELECT COUNT(*) FROM document_tags JOIN tags ON tags.id = document_tags.tag_id '
+                'WHERE tags.name = ?', (tag, )).fetchone()[0]
+
+    def get_tag_freq(self, tag):
+        with self._lock:
+            doc_count = self.get_doc_count()
+            if doc_count:
+                tag_count = self.get_tag_count(tag)
+                return tag_count / float(doc_count)
+            else:
+                return 0.0
+
+    def get_all_tag_counts(self):
+        with self._lock:
+            return dict(self._conn.execute(
+                'SELECT tags.name, COUNT(document_tags.document_id) FROM tags '
+                'LEFT OUTER JOIN document_tags ON tags.id = document_tags.tag_id '
+                'GROUP BY tags.id'))
+
+    def rename_tag(self, old_tag, new_tag):
+        with self._transaction():
+            old_row = self._conn.execute('SELECT id FROM tags WHERE name = ?',
+                                         (old_tag, )).fetchone()
+            new_row = self._conn.execute('SELECT id FROM tags WHERE name = ?',
+                                         (new_tag, )).fetchone()
+            if old_row == new_row:
+                return # The same tag (or none of them exists).
+            if old_row and new_row:
+                # Merge the tags (without duplicating the tag of a document).
+                self._conn.execute(
+                    'UPDATE document_tags SET tag_id = ? WHERE tag_id = ? AND document_id '
+                    'NOT IN (SELECT document_id FROM document_tags WHERE tag_id = ?)',
+                    (new_row[0], old_row[0], new_row[0]))
+                self._conn.execute('DELETE FROM document_tags WHERE tag_id = ?', old_row)
+                self._conn.execute('DELETE FROM tags WHERE id = ?', old_row)
+            elif old_row:
+                self._conn.execute('UPDATE tags SET name = ? WHERE id = ?',
+                                   (new_tag, old_row[0]))
+
+    def update_tags(self, hash_md5, new_tags):
+        self.update_tags_bulk({hash_md5: new_tags})
+
+    # Only the links of the tags that were removed from or added to
+    # each document are deleted or inserted.
+    def update_tags_bulk(self, doc_tags):
+        with self._transaction():
+            document_ids = self._get_document_ids(doc_tags.keys())
+            old_doc_tags = dict([(document_id, {}) for document_id in document_ids.itervalues()])
+            ids = old_doc_tags.keys()
+            for i in xrange(0, len(ids), SQLITE_MAX_IN_VALUES):
+                ids_chunk = ids[i:i + SQLITE_MAX_IN_VALUES]
+                for document_id, tag, tag_id in self._conn.execute(
+                        'SELECT document_tags.document_id, tags.name, tags.id FROM document_tags '
+                        'JOIN tags ON tags.id = document_tags.tag_id '
+                        'WHERE document_tags.document_id IN (%s)' % ', '.join('?' * len(ids_chunk)),
+                        ids_chunk):
+                    old_doc_tags[document_id][tag] = tag_id
+            removed_links, added_links = \
+                _diff_doc_tags(doc_tags, document_ids, old_doc_tags)
+            self._conn.executemany(
+                'DELETE FROM document_tags WHERE document_id = ? AND tag_id = ?', removed_links)
+            self._add_doc_tags(added_links)
+            self._delete_orphan_tags(list(set([tag_id for _, tag_id in removed_links])))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+            self._conn = None
+
+    # Execute the statements of the block in a transaction, committed
+    # if the block succeeds and rolled back otherwise.
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._lock:
+            try:
+                yield
+            except:
+                self._conn.rollback()
+                raise
+            else:
+                self._conn.commit()
+
+    # Get a dict mapping the hashes of the documents found in
+    # the database to the ids of the documents.
+    def _get_document_ids(self, hash_list):
+        hash_list = list(hash_list)
+        document_ids = {}
+        for i in xrange(0, len(hash_list), SQLITE_MAX_IN_VALUES):
+            hash_chunk = hash_list[i:i + SQLITE_MAX_IN_VALUES]
+            document_ids.update(self._conn.execute(
+                'SELECT hash_md5, id FROM documents WHERE hash_md5 IN (%s)' %
+                ', '.join('?' * len(hash_chunk)), hash_chunk))
+        return document_ids
+
+    # Add the (document_id, tag) links, adding the tags that are not in the database.
+    def _add_doc_tags(self, links):
+        self._conn.executemany('INSERT OR IGNORE INTO tags (name) VALUES (?)',
+                               [(tag, ) for tag in set([tag for _, tag in links])])
+        self._conn.executemany('INSERT INTO document_tags (document_id, tag_id) '
+                               'SELECT ?, id FROM tags WHERE name = ?', links)
+
+    # Delete the tags with the given ids that are not used by any document.
+    def _delete_orphan_tags(self, tag_ids):
+        for i in xrange(0, len(tag_ids), SQLITE_MAX_IN_VALUES):
+            tag_ids_chunk = tag_ids[i:i + SQLITE_MAX_IN_VALUES]
+            self._conn.execute(
+                'DELETE FROM tags WHERE id IN (%s) AND id NOT IN '
+                '(SELECT tag_id FROM document_tags WHERE tag_id IN (%s))' %
+                ((', '.join('?' * len(tag_ids_chunk)), ) * 2), tag_ids_chunk * 2)
+
+    # Create the Document objects of rows of the documents table (selected
+    # by _select_docs), fetching their tags with a single query.
+    def _create_docs(self, rows):
+        if not rows:
+            return []
+        doc_tags = dict([(row[0], set()) for row in rows])
+        document_ids = doc_tags.keys()
+        for i in xrange(0, len(document_ids), SQLITE_MAX_IN_VALUES):
+            ids_chunk = document_ids[i:i + SQLITE_MAX_IN_VALUES]
+            for document_id, tag in self._conn.execute(
+                    'SELECT document_tags.document_id, tags.name FROM document_tags '
+                    'JOIN tags ON tags.id = document_tags.tag_id '
+                    'WHERE document_tags.document_id IN (%s)' % ', '.join('?' * len(ids_chunk)),
+                    ids_chunk):
+                doc_tags[document_id].add(tag)
+        return [Document(*(tuple(row[1:]) + (doc_tags[row[0]], ))) for row in rows]
@@ -22,7 +22,12 @@ class DigitalLibraryError(Exception):
 
 
 class DocumentError(DigitalLibraryError):
-    pass
+
+    # The stage of the import of the document where the error was
+    # found (one of the diglib.core.ingest.STAGE_* constants), if any.
+    def __init__(self, stage=None):
+        super(DocumentError, self).__init__()
+        self.stage = stage
 
 class DocumentNotFound(DocumentError):
     pass
@@ -41,3 +46,7 @@ class DocumentNotRetrievable(DocumentError):
 
 class DocumentNotSupported(DocumentError):
     pass
+
+
+class ImportJobNotFound(DigitalLibraryError):
+    pass
@@ -53,6 +53,31 @@ class FileHandler(object):
     def get_thumbnail(self, width, height):
         raise NotImplementedError()
 
+    # Return a dict mapping each of the given sizes to the data of a square
+    # thumbnail of that size (as returned by get_thumbnail). The document is
+    # rendered once for the largest size and the other thumbnails are scaled
+    # down from that image.
+    def get_thumbnails(self, sizes):
+        if not sizes:
+            return {}
+        largest_size = max(sizes)
+        largest_thumbnail = self.get_thumbnail(largest_size, largest_size)
+        thumbnails = {}
+        if largest_thumbnail:
+            image = PIL.Image.open(cStringIO.StringIO(largest_thumbnail))
+            image.load()
+            for size in sizes:
+                if size == largest_size:
+                    thumbnails[size] = largest_thumbnail
+                else:
+                    thumbnail_image = image.copy()
+                    thumbnail_image.thumbnail((size, size), PIL.Image.ANTIALIAS)
+                    thumbnails[size] = _get_png_data(thumbnail_image)
+        else:
+            for size in sizes:
+                thumbnails[size] = largest_thumbnail
+        return thumbnails
+
     # Return the file of the file in an UTF-8 encoded string.
     # If the file is not available it should return ''.
     def get_content(self):
@@ -156,20 +181,18 @@ class DJVUHandler(FileHandler):
         return ''
 
     def get_thumbnail(self, width, height):
+        # Let DjVuLibre render the page directly at the size of the thumbnail.
+        scale = min(1.0, width / float(self._page_job.width),
+                    height / float(self._page_job.height))
+        image_width = max(1, int(scale * self._page_job.width))
+        image_height = max(1, int(scale * self._page_job.height))
         data = self._page_job.render(
             djvu.decode.RENDER_COLOR,
-            (0, 0, self._page_job.width, self._page_job.height),
-            (0, 0, self._page_job.width, self._page_job.height),
+            (0, 0, image_width, image_height),
+            (0, 0, image_width, image_height),
             self._pixel_format)
-        page_size = (self._page_job.width, self._page_job.height)
-        thumbnail_size = (width, height)
-        image = PIL.Image.fromstring('RGB', page_size, data)
-        image.thumbnail(thumbnail_size, PIL.Image.ANTIALIAS)
-        file = cStringIO.StringIO()
-        image.save(file, 'PNG')
-        thumbnail = file.getvalue()
-        file.close()
-        return thumbnail
+        image = PIL.Image.fromstring('RGB', (image_width, image_height), data)
+        return _get_png_data(image)
 
     def get_content(self):
         args = ['djvutxt', self._file_path]
@@ -226,6 +249,14 @@ class PSHandler(FileHandler):
         pass
 
 
+def _get_png_data(image):
+    file = cStringIO.StringIO()
+    image.save(file, 'PNG')
+    data = file.getvalue()
+    file.close()
+    return data
+
+
 _HANDLERS = dict([(handler.mime_type, handler)
                   for handler in FileHandler.__subclasses__()])
 
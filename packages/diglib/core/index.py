@@ -16,23 +16,59 @@
 # You should have received a copy of the GNU General Public License along
 # with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import time
+import weakref
+import threading
+import contextlib
+import collections
+
 import xapian
 
+from diglib.core import error
 from diglib.core.lang import LANGUAGES, get_stopwords
 
 
+# Commit policy of the modifications made outside transactions. The
+# modifications are written to disk once commit_docs of them are pending or
+# commit_interval seconds (if it is not None) passed since the last commit,
+# which is checked when the index is modified or searched. They are also
+# written by commit, begin_transaction and close. The searches only see the
+# modifications written to disk, and the pending modifications are lost if
+# the process is killed. With the default policy each modification is written
+# to disk before the method returns.
+#
+# The modifications made in a transaction are written to disk (all of them
+# or none) by commit_transaction, and a transaction interrupted by a crash
+# is lost as a whole.
+
 class Index(object):
 
-    def __init__(self, index_dir):
+    COMMIT_DOCS = 1
+    COMMIT_INTERVAL = None
+
+    # Number of documents fetched at once when the results are iterated.
+    SEARCH_CHUNK_SIZE = 100
+
+    def __init__(self, index_dir, commit_docs=COMMIT_DOCS, commit_interval=COMMIT_INTERVAL):
         pass
 
-    def add_doc(self, doc, content, metadata):
+    # Add a document with the terms given by analyze_doc.
+    def add_doc(self, doc, terms):
         raise NotImplementedError()
 
-    # Get the number of terms of a document.
+    # Get the number of terms of a document (without its tags), as given by
+    # analyze_doc when the document was added.
     def get_doc_terms_count(self, hash_md5):
         raise NotImplementedError()
 
+    # Analyze the content and the metadata of a document without adding it
+    # (e.g. in a worker process). Return a (terms, terms_count) tuple, where
+    # terms is a picklable object passed to add_doc and terms_count is the
+    # number of terms the document would have in the index (without its tags).
+    @classmethod
+    def analyze_doc(cls, language_code, content, metadata):
+        raise NotImplementedError()
+
     def delete_doc(self, hash_md5):
         raise NotImplementedError()
 
@@ -42,8 +78,54 @@ class Index(object):
     def update_tags(self, hash_md5, tags):
         raise NotImplementedError()
 
-    # Get the MD5 hashes of the documents with the given tags that match the query.
-    def search(self, query, tags, start=None, count=None):
+    # Get the MD5 hashes of the documents with the given tags that match the
+    # query. If languages is given, only the documents in those languages
+    # are searched.
+    def search(self, query, tags, start=None, count=None, languages=None):
+        raise NotImplementedError()
+
+    # Search the documents like search, returning an object with the
+    # attributes matches_estimated, matches_lower_bound and
+    # matches_upper_bound (estimates of the number of results), and a
+    # get_page(start, count) method. Iterating the object gives the MD5
+    # hashes of the results, fetched from the index in chunks of
+    # chunk_size documents.
+    def search_results(self, query, tags, languages=None, chunk_size=SEARCH_CHUNK_SIZE):
+        raise NotImplementedError()
+
+    # Group the following modifications of the index until commit_transaction
+    # is called. The modifications are discarded by cancel_transaction.
+    def begin_transaction(self):
+        raise NotImplementedError()
+
+    def commit_transaction(self):
+        raise NotImplementedError()
+
+    def cancel_transaction(self):
+        raise NotImplementedError()
+
+    def in_transaction(self):
+        raise NotImplementedError()
+
+    # Execute the modifications of the block in a transaction, committed if
+    # the block succeeds and cancelled otherwise. If the calling thread is
+    # in a transaction the modifications are part of it.
+    @contextlib.contextmanager
+    def transaction(self):
+        if self.in_transaction():
+            yield
+        else:
+            self.begin_transaction()
+            try:
+                yield
+            except:
+                self.cancel_transaction()
+                raise
+            else:
+                self.commit_transaction()
+
+    # Write to disk the modifications pending by the commit policy.
+    def commit(self):
         raise NotImplementedError()
 
     def close(self):
@@ -59,102 +141,339 @@ class XapianIndex(Index):
     CONTENT_PREFIX = 'C'
     METADATA_PREFIX = 'M'
     TAG_PREFIX = 'T'
+    LANGUAGE_PREFIX = 'L'
+
+    # Value slot with the number of terms of the content and the metadata
+    # of each document (serialised with xapian.sortable_serialise).
+    TERMS_COUNT_SLOT = 0
+
+    # Flags used to parse the queries.
+    TAG_QUERY_FLAGS = xapian.QueryParser.FLAG_LOVEHATE | xapian.QueryParser.FLAG_BOOLEAN
+    QUERY_FLAGS = TAG_QUERY_FLAGS | xapian.QueryParser.FLAG_PHRASE
+
+    # Maximum number of parsed queries kept by _parse_query (in each thread).
+    QUERY_CACHE_SIZE = 100
 
-    def __init__(self, index_dir):
-        super(XapianIndex, self).__init__(index_dir)
+    # Times a read is attempted when the revision of a reader is overwritten
+    # by the writer (xapian.DatabaseModifiedError) before giving up.
+    READ_ATTEMPTS = 5
+
+    def __init__(self, index_dir, commit_docs=Index.COMMIT_DOCS,
+                 commit_interval=Index.COMMIT_INTERVAL):
+        super(XapianIndex, self).__init__(index_dir, commit_docs, commit_interval)
+        self._index_dir = index_dir
         self._index = xapian.WritableDatabase(index_dir, xapian.DB_CREATE_OR_OPEN)
-        self._stoppers = {}
-        for lang in LANGUAGES:
-            stopper = xapian.SimpleStopper()
-            for stopword in get_stopwords(lang):
-                stopper.add(stopword)
-            self._stoppers[lang] = stopper
+        # Read-only databases used by the searches, one per thread, so they
+        # are not serialized with the modifications made by the writer. Each
+        # thread also keeps its parsed queries (see _parse_query).
+        self._readers = threading.local()
+        self._all_readers = weakref.WeakKeyDictionary() # Maps threads to readers.
+        self._readers_lock = threading.Lock()
+        self._commit_revision = 0 # Incremented when the index is written to disk.
+        # The writer is used by a thread at a time, and a thread holds it
+        # during the whole transaction (the threads that modify the index in
+        # the meantime wait for it instead of joining the transaction).
+        self._writer_lock = threading.RLock()
+        self._transaction = threading.local()
+        self._commit_docs = commit_docs
+        self._commit_interval = commit_interval
+        self._pending_count = 0 # Modifications not written to disk.
+        self._commit_time = time.time()
+        self._parser, self._lang_parsers = self._create_parsers()
+        self._parsers_lock = threading.Lock()
 
-    def add_doc(self, doc, content, metadata):
-        generator = xapian.TermGenerator()
-        generator.index_text_without_positions(metadata, 1, self.METADATA_PREFIX)
-        # Index the content of the document.
-        generator.set_stemmer(xapian.Stem(doc.language_code))
-        generator.set_stopper(self._stoppers[doc.language_code])
-        generator.index_text(content, 1, self.CONTENT_PREFIX)
-        xapian_doc = generator.get_document()
+    # The terms are given as (term, wdf, positions) tuples, so the content
+    # is not tokenized again.
+    def add_doc(self, doc, terms):
+        xapian_doc = xapian.Document()
+        for term, wdf, positions in terms:
+            xapian_doc.add_term(term, wdf)
+            for position in positions:
+                xapian_doc.add_posting(term, position, 0)
+        xapian_doc.add_value(self.TERMS_COUNT_SLOT,
+                             xapian.sortable_serialise(xapian_doc.termlist_count()))
         for tag in doc.tags:
             xapian_doc.add_boolean_term(self.TAG_PREFIX + tag)
+        xapian_doc.add_boolean_term(self.LANGUAGE_PREFIX + doc.language_code)
         xapian_doc.add_boolean_term(self.ID_PREFIX + doc.hash_md5)
         xapian_doc.set_data(doc.hash_md5)
-        self._index.add_document(xapian_doc)
-        self._index.flush()
+        with self._writer_lock:
+            self._index.add_document(xapian_doc)
+            self._flush()
 
+    # The number of terms is read from the value of the document, without
+    # reading its term list (except for the documents added by previous
+    # versions, counting all their terms).
     def get_doc_terms_count(self, hash_md5):
-        xapian_doc = self._get_xapian_doc(hash_md5)
-        terms_count = xapian_doc.termlist_count()
-        return terms_count
+        with self._writer_lock:
+            xapian_doc = self._get_xapian_doc(hash_md5)
+            terms_count = xapian_doc.get_value(self.TERMS_COUNT_SLOT)
+            if terms_count:
+                return int(xapian.sortable_unserialise(terms_count))
+            else:
+                return xapian_doc.termlist_count()
+
+    @classmethod
+    def analyze_doc(cls, language_code, content, metadata):
+        xapian_doc = cls._create_xapian_doc(language_code, content, metadata)
+        terms = [(item.term, item.wdf, list(item.positer))
+                 for item in xapian_doc.termlist()]
+        return terms, len(terms)
 
     def delete_doc(self, hash_md5):
-        self._index.delete_document(self.ID_PREFIX + hash_md5)
-        self._index.flush()
+        with self._writer_lock:
+            self._index.delete_document(self.ID_PREFIX + hash_md5)
+            self._flush()
 
+    # The documents with the tag are read from the posting list of its term.
     def rename_tag(self, old_tag, new_tag):
-        old_term = self.TAG_PREFIX + old_tag
-        new_term = self.TAG_PREFIX + new_tag
-        enquire = xapian.Enquire(self._index)
-        enquire.set_query(xapian.Query(old_term))
-        mset = enquire.get_mset(0, self._index.get_doccount())
-        for match in mset:
-            xapian_doc = match.document
-            xapian_doc.remove_term(old_term)
-            xapian_doc.add_boolean_term(new_term)
-            self._index.replace_document(xapian_doc.get_docid(), xapian_doc)
-        self._index.flush()
+        with self._writer_lock:
+            old_term = self._get_tag_term(old_tag)
+            new_term = self._get_tag_term(new_tag)
+            docids = [posting.docid for posting in self._index.postlist(old_term)]
+            for docid in docids:
+                xapian_doc = self._index.get_document(docid)
+                xapian_doc.remove_term(old_term)
+                xapian_doc.add_boolean_term(new_term)
+                self._index.replace_document(docid, xapian_doc)
+            self._flush()
 
+    # Only the tag terms that changed are removed from or added to the
+    # document. The tag terms are found by skipping to the prefix in the
+    # (sorted) term list of the document.
     def update_tags(self, hash_md5, tags):
-        xapian_doc = self._get_xapian_doc(hash_md5)
-        for term in xapian_doc:
-            if term.term.startswith(self.TAG_PREFIX):
-                xapian_doc.remove_term(term.term)
-        for tag in tags:
-            xapian_doc.add_boolean_term(self.TAG_PREFIX + tag)
-        self._index.replace_document(xapian_doc.get_docid(), xapian_doc)
-        self._index.flush()
+        with self._writer_lock:
+            xapian_doc = self._get_xapian_doc(hash_md5)
+            old_terms = set()
+            terms = xapian_doc.termlist()
+            try:
+                term = terms.skip_to(self.TAG_PREFIX)
+                while term.term.startswith(self.TAG_PREFIX):
+                    old_terms.add(term.term)
+                    term = terms.next()
+            except StopIteration:
+                pass
+            new_terms = set([self._get_tag_term(tag) for tag in tags])
+            if old_terms != new_terms:
+                for term in old_terms - new_terms:
+                    xapian_doc.remove_term(term)
+                for term in new_terms - old_terms:
+                    xapian_doc.add_boolean_term(term)
+                self._index.replace_document(xapian_doc.get_docid(), xapian_doc)
+                self._flush()
+
+    # The documents added by previous versions (without the language term)
+    # are not found if languages is given. The results (all of them or the
+    # requested page) are read in a single MSet.
+    def search(self, query, tags, start=None, count=None, languages=None):
+        reader, enquire = self._create_enquire(query, tags, languages)
+        if start is None or count is None:
+            start, count = 0, None
+        return _read_retrying(reader, self.READ_ATTEMPTS, _get_mset_data,
+                              reader, enquire, start, count)[1]
+
+    # The results are read from a read-only database of the calling thread,
+    # so they should be iterated in that thread.
+    def search_results(self, query, tags, languages=None,
+                       chunk_size=Index.SEARCH_CHUNK_SIZE):
+        reader, enquire = self._create_enquire(query, tags, languages)
+        return XapianSearchResults(reader, enquire, chunk_size, self.READ_ATTEMPTS)
+
+    # The pending modifications are written to disk before the transaction.
+    # The writer is held by the thread until the transaction is committed
+    # or cancelled.
+    def begin_transaction(self):
+        self._writer_lock.acquire()
+        try:
+            self.commit()
+            self._index.begin_transaction()
+        except:
+            self._writer_lock.release()
+            raise
+        self._transaction.active = True
+
+    def commit_transaction(self):
+        try:
+            self._index.commit_transaction()
+            self._commit_time = time.time()
+            self._commit_revision += 1
+        finally:
+            self._transaction.active = False
+            self._writer_lock.release()
+
+    def cancel_transaction(self):
+        try:
+            self._index.cancel_transaction()
+        finally:
+            self._transaction.active = False
+            self._writer_lock.release()
+
+    # Check if the calling thread is in a transaction.
+    def in_transaction(self):
+        return getattr(self._transaction, 'active', False)
+
+    def commit(self):
+        with self._writer_lock:
+            if self._pending_count > 0:
+                self._index.flush()
+                self._pending_count = 0
+                self._commit_time = time.time()
+                self._commit_revision += 1
 
-    def search(self, query, tags, start=None, count=None):
-        enquire = xapian.Enquire(self._index)
-        query = self._parse_query(query) if query.strip() else xapian.Query.MatchAll
+    def close(self):
+        if self.in_transaction():
+            self.cancel_transaction()
+        with self._writer_lock:
+            self._index.flush()
+            self._index = None
+        with self._readers_lock:
+            for reader in self._all_readers.values():
+                reader.close()
+            self._all_readers.clear()
+
+    # Count a modification and write the pending modifications to disk if
+    # required by the commit policy, unless the modification is part of a
+    # transaction (it will be written when the transaction is committed).
+    # Called with the writer held.
+    def _flush(self):
+        if not self.in_transaction():
+            self._pending_count += 1
+            if self._pending_count >= self._commit_docs or self._commit_expired():
+                self.commit()
+
+    def _commit_expired(self):
+        return (self._pending_count > 0 and self._commit_interval is not None and
+                time.time() - self._commit_time >= self._commit_interval)
+
+    # Write the pending modifications to disk if the commit interval passed,
+    # so the searches find them without waiting for another modification.
+    # Nothing is done if the writer is being used by another thread (e.g.
+    # during a transaction, which writes them before it begins).
+    def _commit_if_expired(self):
+        if self._commit_expired() and self._writer_lock.acquire(False):
+            try:
+                self.commit()
+            finally:
+                self._writer_lock.release()
+
+    # Create a Xapian document with the terms of the content and the metadata.
+    @classmethod
+    def _create_xapian_doc(cls, language_code, content, metadata):
+        generator = xapian.TermGenerator()
+        generator.index_text_without_positions(metadata, 1, cls.METADATA_PREFIX)
+        # Index the content of the document.
+        generator.set_stemmer(xapian.Stem(language_code))
+        generator.set_stopper(_get_stopper(language_code))
+        generator.index_text(content, 1, cls.CONTENT_PREFIX)
+        return generator.get_document()
+
+    # Return the term of a tag (as a UTF-8 string, like the terms read from the index).
+    def _get_tag_term(self, tag):
+        if isinstance(tag, unicode):
+            tag = tag.encode('utf-8')
+        return self.TAG_PREFIX + tag
+
+    # Get the document id from the posting list of the unique term of the
+    # document, which has a single entry.
+    def _get_docid(self, hash_md5):
+        for posting in self._index.postlist(self.ID_PREFIX + hash_md5):
+            return posting.docid
+        raise error.DocumentNotFound()
+
+    def _get_xapian_doc(self, hash_md5):
+        return self._index.get_document(self._get_docid(hash_md5))
+
+    # Return the reader of the calling thread and an Enquire of the query.
+    def _create_enquire(self, query, tags, languages):
+        reader = self._get_reader()
+        enquire = xapian.Enquire(reader)
+        query = self._parse_query(query, languages) if query.strip() else xapian.Query.MatchAll
         filter = xapian.Query.MatchAll if not tags else \
             xapian.Query(xapian.Query.OP_AND, [self.TAG_PREFIX + tag for tag in tags])
+        if languages is not None:
+            language_filter = xapian.Query(xapian.Query.OP_OR,
+                                           [self.LANGUAGE_PREFIX + lang for lang in languages])
+            filter = xapian.Query(xapian.Query.OP_FILTER, filter, language_filter)
         final_query = xapian.Query(xapian.Query.OP_FILTER, query, filter)
         enquire.set_docid_order(xapian.Enquire.DONT_CARE)
         enquire.set_query(final_query)
-        mset = enquire.get_mset(start, count) \
-            if start is not None and count is not None \
-            else enquire.get_mset(0, self._index.get_doccount())
-        return [match.document.get_data() for match in mset]
+        return reader, enquire
 
-    def close(self):
-        self._index.flush()
-        self._index = None
+    # Get the read-only database of the calling thread, reopened at the
+    # latest revision if the writer committed since it was last used. The
+    # readers of the threads that finished are released with the threads.
+    def _get_reader(self):
+        self._commit_if_expired()
+        commit_revision = self._commit_revision
+        reader = getattr(self._readers, 'database', None)
+        if reader is None:
+            reader = xapian.Database(self._index_dir)
+            self._readers.database = reader
+            self._readers.query_cache = collections.OrderedDict()
+            with self._readers_lock:
+                self._all_readers[threading.current_thread()] = reader
+        elif self._readers.revision != commit_revision:
+            reader.reopen()
+            # The queries depend on the contents seen by the reader.
+            self._readers.query_cache.clear()
+        self._readers.revision = commit_revision
+        return reader
 
-    def _get_xapian_doc(self, hash_md5):
-        enquire = xapian.Enquire(self._index)
-        enquire.set_query(xapian.Query(self.ID_PREFIX + hash_md5))
-        mset = enquire.get_mset(0, 1)
-        xapian_doc = self._index.get_document(mset[0].docid)
-        return xapian_doc
-
-    def _parse_query(self, query):
+    # Create the parser of the tags, metadata and content of the queries,
+    # and the parsers of the content stemmed in each of the languages. They
+    # are not bound to a database (the flags used do not read the index),
+    # so the searches do not use the writer.
+    def _create_parsers(self):
         parser = xapian.QueryParser()
-        parser.set_database(self._index)
         parser.set_default_op(xapian.Query.OP_AND)
-        default_flags = xapian.QueryParser.FLAG_LOVEHATE | xapian.QueryParser.FLAG_BOOLEAN | xapian.QueryParser.FLAG_PHRASE
-        tag_query = parser.parse_query(query, xapian.QueryParser.FLAG_LOVEHATE | xapian.QueryParser.FLAG_BOOLEAN, self.TAG_PREFIX)
-        metadata_query = parser.parse_query(query, default_flags, self.METADATA_PREFIX)
-        content_query = parser.parse_query(query, default_flags, self.CONTENT_PREFIX)
-        stemming_query = xapian.Query.MatchNothing
+        lang_parsers = []
         for lang in LANGUAGES:
-            parser.set_stemmer(xapian.Stem(lang))
-            parser.set_stemming_strategy(xapian.QueryParser.STEM_SOME)
-            parser.set_stopper(self._stoppers[lang])
-            lang_query = parser.parse_query(query, default_flags, self.CONTENT_PREFIX)
+            lang_parser = xapian.QueryParser()
+            lang_parser.set_default_op(xapian.Query.OP_AND)
+            lang_parser.set_stemmer(xapian.Stem(lang))
+            lang_parser.set_stemming_strategy(xapian.QueryParser.STEM_SOME)
+            lang_parser.set_stopper(_get_stopper(lang))
+            lang_parsers.append(lang_parser)
+        return parser, lang_parsers
+
+    # The parsed queries are cached in each thread, the most recently used
+    # last, because the Xapian objects cannot be shared by the threads. The
+    # parsers are shared, so the queries are parsed one at a time.
+    def _parse_query(self, query, languages=None):
+        reader = self._get_reader()
+        query_cache = self._readers.query_cache
+        if languages is not None:
+            languages = frozenset(languages)
+        key = (query, self.QUERY_FLAGS, languages)
+        final_query = query_cache.pop(key, None)
+        if final_query is None:
+            with self._parsers_lock:
+                final_query = self._create_query(query, self.QUERY_FLAGS,
+                                                 languages, reader)
+            if len(query_cache) >= self.QUERY_CACHE_SIZE:
+                query_cache.popitem(last=False)
+        query_cache[key] = final_query # Most recently used.
+        return final_query
+
+    # The content of each document is only stemmed in its language, so
+    # the query stemmed in a language is only matched against the documents
+    # in that language (unless there are documents without the language
+    # term, added by previous versions).
+    def _create_query(self, query, flags, languages, reader):
+        parser = self._parser
+        tag_query = parser.parse_query(query, self.TAG_QUERY_FLAGS, self.TAG_PREFIX)
+        metadata_query = parser.parse_query(query, flags, self.METADATA_PREFIX)
+        content_query = parser.parse_query(query, flags, self.CONTENT_PREFIX)
+        filter_languages = _read_retrying(reader, self.READ_ATTEMPTS,
+                                          self._has_language_terms, reader)
+        stemming_query = xapian.Query.MatchNothing
+        for lang, lang_parser in zip(LANGUAGES, self._lang_parsers):
+            if languages is not None and lang not in languages:
+                continue
+            lang_query = lang_parser.parse_query(query, flags, self.CONTENT_PREFIX)
+            if filter_languages:
+                lang_query = xapian.Query(xapian.Query.OP_FILTER, lang_query,
+                                          xapian.Query(self.LANGUAGE_PREFIX + lang))
             stemming_query = xapian.Query(xapian.Query.OP_OR, stemming_query, lang_query)
         tag_query = xapian.Query(xapian.Query.OP_SCALE_WEIGHT, tag_query, 20)
         metadata_query = xapian.Query(xapian.Query.OP_SCALE_WEIGHT, metadata_query, 10)
@@ -163,3 +482,89 @@ class XapianIndex(Index):
                                    [tag_query, metadata_query,
                                     content_query, stemming_query])
         return final_query
+
+    # Check if all the documents of the reader have a language term.
+    def _has_language_terms(self, reader):
+        lang_count = sum([reader.get_termfreq(self.LANGUAGE_PREFIX + lang)
+                          for lang in LANGUAGES])
+        return lang_count == reader.get_doccount()
+
+
+# Results of a search in a XapianIndex (see Index.search_results). The
+# estimates are given by the first chunk of results, fetched when the object
+# is created. The results are fetched from the reader as it is when each chunk
+# is read, so a document added or deleted while they are iterated could be
+# skipped or returned twice. If the revision being read is overwritten by the
+# writer, the reader is reopened and the chunk is read again.
+
+class XapianSearchResults(object):
+
+    def __init__(self, reader, enquire, chunk_size, read_attempts):
+        super(XapianSearchResults, self).__init__()
+        self._reader = reader
+        self._enquire = enquire
+        self._chunk_size = chunk_size
+        self._read_attempts = read_attempts
+        first_mset, self._first_chunk = self._read_chunk(0, chunk_size)
+        self.matches_estimated = first_mset.get_matches_estimated()
+        self.matches_lower_bound = first_mset.get_matches_lower_bound()
+        self.matches_upper_bound = first_mset.get_matches_upper_bound()
+
+    def __iter__(self):
+        chunk = self._first_chunk
+        start = 0
+        while True:
+            for hash_md5 in chunk:
+                yield hash_md5
+            if len(chunk) < self._chunk_size:
+                break
+            start += self._chunk_size
+            chunk = self._read_chunk(start, self._chunk_size)[1]
+
+    def get_page(self, start, count):
+        if start + count <= self._chunk_size:
+            return self._first_chunk[start:start + count]
+        else:
+            return self._read_chunk(start, count)[1]
+
+    # Get the MSet and the hashes of the documents of a chunk of results.
+    def _read_chunk(self, start, count):
+        return _read_retrying(self._reader, self._read_attempts, _get_mset_data,
+                              self._reader, self._enquire, start, count)
+
+
+# Get an MSet of the Enquire and the hashes of its documents. All the
+# matches are read if count is None.
+def _get_mset_data(reader, enquire, start, count):
+    if count is None:
+        count = reader.get_doccount()
+    mset = enquire.get_mset(start, count)
+    return mset, [match.document.get_data() for match in mset]
+
+
+# Call function(*args) and return its result. If the revision being read is
+# overwritten by the writer, the reader is reopened and the function is
+# called again (at most attempts times in total).
+def _read_retrying(reader, attempts, function, *args):
+    attempt = 1
+    while True:
+        try:
+            return function(*args)
+        except xapian.DatabaseModifiedError:
+            if attempt >= attempts:
+                raise
+            attempt += 1
+            reader.reopen()
+
+
+# The stoppers are created once in each process, the first time they are used.
+_stoppers = {}
+
+def _get_stopper(lang):
+    stopper = _stoppers.get(lang)
+    if stopper is None:
+        stopper = xapian.SimpleStopper()
+        for stopword in get_stopwords(lang):
+            stopper.add(stopword)
+        _stoppers[lang] = stopper
+    return stopper
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+#
+# diglib: Personal digital document management software.
+# Copyright (C) 2011-2015 Yasser Gonzalez <yasserglez@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import stat
+import fcntl
+import ctypes
+import shutil
+import hashlib
+import ctypes.util
+
+import magic
+import ssdeep
+
+from diglib.core import error
+from diglib.core.lang import get_lang
+from diglib.core.handlers import get_handler
+
+
+# Stages of the import of a document, from the cheapest to the most
+# expensive one. A document rejected in a stage does not go through the
+# following ones, and the stage is reported in the `stage` attribute of
+# the exception raised.
+#
+# STAGE_STAT     Check that the document is a non-empty regular file.
+# STAGE_MIME     Detect the MIME type of the document from its first bytes.
+# STAGE_HASH     Hash the document and look for exact and similar duplicates.
+# STAGE_CONTENT  Extract the content and check if the document is retrievable.
+# STAGE_STORE    Place the document in the library, write the thumbnails
+#                and add the document to the index and the database.
+STAGE_STAT = 'stat'
+STAGE_MIME = 'mime'
+STAGE_HASH = 'hash'
+STAGE_CONTENT = 'content'
+STAGE_STORE = 'store'
+
+
+# The STAGE_STAT, STAGE_MIME and STAGE_HASH (except the lookup of
+# duplicates) stages and the extraction in STAGE_CONTENT do not touch the
+# library, so they can be executed in worker processes.
+
+class ScannedDoc(object):
+
+    def __init__(self, doc_path, doc_size, hash_md5, hash_ssdeep, mime_type):
+        self.doc_path = doc_path
+        self.doc_size = doc_size
+        self.hash_md5 = hash_md5
+        self.hash_ssdeep = hash_ssdeep
+        self.mime_type = mime_type
+
+
+class ExtractedDoc(ScannedDoc):
+
+    def __init__(self, scanned_doc, thumbnails, terms, language_code, terms_count):
+        super(ExtractedDoc, self).__init__(
+            scanned_doc.doc_path, scanned_doc.doc_size, scanned_doc.hash_md5,
+            scanned_doc.hash_ssdeep, scanned_doc.mime_type)
+        self.thumbnails = thumbnails # Maps each size to the PNG data.
+        self.terms = terms # Given by Index.analyze_doc.
+        self.language_code = language_code
+        self.terms_count = terms_count
+
+
+# The documents are read in chunks of this size (in bytes), so the memory
+# used does not depend on the size of the document. The MIME type is
+# detected using the first chunk, which is also libmagic's default limit.
+CHUNK_SIZE = 1024 * 1024
+
+
+# Check the document in the given path and compute its size, hashes and
+# MIME type, reading it only once and one chunk at a time. The document
+# is rejected without hashing it if its MIME type is not supported.
+def scan_doc(doc_path, mime_types):
+    doc_stat = os.stat(doc_path)
+    if not stat.S_ISREG(doc_stat.st_mode) or doc_stat.st_size == 0:
+        raise error.DocumentNotSupported(stage=STAGE_STAT)
+    doc_size = 0
+    md5 = hashlib.md5()
+    fuzzy = ssdeep.Hash()
+    with open(doc_path, 'rb') as file:
+        chunk = file.read(CHUNK_SIZE)
+        mime_type = _get_magic().buffer(chunk)
+        if mime_type not in mime_types:
+            raise error.DocumentNotSupported(stage=STAGE_MIME)
+        while chunk:
+            doc_size += len(chunk)
+            md5.update(chunk)
+            fuzzy.update(chunk)
+            chunk = file.read(CHUNK_SIZE)
+    return ScannedDoc(doc_path, doc_size, md5.hexdigest(), fuzzy.digest(), mime_type)
+
+
+# Extract the information of a scanned document. The terms are computed
+# using the given Index class (see Index.analyze_doc). The document is
+# rejected before rendering the thumbnails if it has less than min_terms
+# terms (the caller passes 0 if the document will be tagged).
+def extract_doc(scanned_doc, thumbnail_sizes, index_class, min_terms=0):
+    handler = get_handler(scanned_doc.doc_path, scanned_doc.mime_type)
+    try:
+        content = handler.get_content()
+        metadata = handler.get_metadata()
+        language_code = get_lang(content)
+        terms, terms_count = index_class.analyze_doc(language_code, content, metadata)
+        if terms_count < min_terms:
+            raise error.DocumentNotRetrievable(stage=STAGE_CONTENT)
+        thumbnails = handler.get_thumbnails(thumbnail_sizes)
+    finally:
+        handler.close()
+    return ExtractedDoc(scanned_doc, thumbnails, terms, language_code, terms_count)
+
+
+# Render the thumbnails of a document of the given MIME type. Return a dict
+# mapping each size to the PNG data (empty if the document does not have
+# thumbnails), or None if they could not be rendered.
+def render_thumbnails(doc_path, mime_type, thumbnail_sizes):
+    try:
+        handler = get_handler(doc_path, mime_type)
+        try:
+            return handler.get_thumbnails(thumbnail_sizes)
+        finally:
+            handler.close()
+    except Exception:
+        return None
+
+
+# Callable objects to execute scan_doc and extract_doc using a
+# multiprocessing.Pool. The exceptions are returned instead of raised.
+
+class Scanner(object):
+
+    def __init__(self, mime_types):
+        self._mime_types = mime_types
+
+    # Return a (doc_path, result) tuple, where result is
+    # the ScannedDoc object or the exception raised.
+    def __call__(self, doc_path):
+        try:
+            result = scan_doc(doc_path, self._mime_types)
+        except Exception as e:
+            result = e
+        return doc_path, result
+
+
+class Extractor(object):
+
+    def __init__(self, thumbnail_sizes, index_class, min_terms=0):
+        self._thumbnail_sizes = thumbnail_sizes
+        self._index_class = index_class
+        self._min_terms = min_terms
+
+    # Return the ExtractedDoc object or the exception raised.
+    def __call__(self, scanned_doc):
+        try:
+            return extract_doc(scanned_doc, self._thumbnail_sizes,
+                               self._index_class, self._min_terms)
+        except Exception as e:
+            return e
+
+
+# Ways of placing a document in the library. Copying is always possible and
+# it is the fallback if the selected method is not supported for the given
+# source and destination paths.
+#
+# PLACEMENT_COPY      Copy the data of the document.
+# PLACEMENT_HARDLINK  Create a hard link to the original document (only if it
+#                     is in the same file system). The original document and
+#                     the one in the library will be the same file.
+# PLACEMENT_REFLINK   Clone the original document using a copy-on-write
+#                     reflink (e.g. Btrfs or XFS).
+# PLACEMENT_SENDFILE  Copy the data in the kernel using sendfile(2).
+# PLACEMENT_MOVE      Create a hard link (or copy) and the caller removes the
+#                     original document once it is added to the library.
+PLACEMENT_COPY = 'copy'
+PLACEMENT_HARDLINK = 'hardlink'
+PLACEMENT_REFLINK = 'reflink'
+PLACEMENT_SENDFILE = 'sendfile'
+PLACEMENT_MOVE = 'move'
+
+PLACEMENTS = (PLACEMENT_COPY, PLACEMENT_HARDLINK, PLACEMENT_REFLINK,
+              PLACEMENT_SENDFILE, PLACEMENT_MOVE)
+
+
+# Place the document in src_path at dst_path using the given method.
+def place_doc(src_path, dst_path, placement):
+    if placement in (PLACEMENT_HARDLINK, PLACEMENT_MOVE):
+        try:
+            os.link(src_path, dst_path)
+            return
+        except OSError:
+            pass # Different file system, link limit, already exists, etc.
+    elif placement == PLACEMENT_REFLINK:
+        try:
+            _reflink(src_path, dst_path)
+            return
+        except (IOError, OSError):
+            pass # The file system does not support reflinks.
+    elif placement == PLACEMENT_SENDFILE and _libc_sendfile is not None:
+        try:
+            _sendfile(src_path, dst_path)
+            return
+        except (IOError, OSError):
+            pass
+    shutil.copyfile(src_path, dst_path)
+
+
+# The FICLONE ioctl from linux/fs.h.
+_FICLONE = 0x40049409
+
+def _reflink(src_path, dst_path):
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+
+
+# os.sendfile is not available in Python 2, so sendfile64 is called from
+# the C library (it is None if the C library does not provide it).
+def _load_libc_sendfile():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        sendfile = libc.sendfile64
+    except (OSError, AttributeError):
+        return None
+    sendfile.argtypes = (ctypes.c_int, ctypes.c_int,
+                         ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t)
+    sendfile.restype = ctypes.c_ssize_t
+    return sendfile
+
+_libc_sendfile = _load_libc_sendfile()
+
+
+# The kernel updates the offset after each call.
+def _sendfile(src_path, dst_path):
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        size = os.fstat(src.fileno()).st_size
+        offset = ctypes.c_int64(0)
+        while offset.value < size:
+            sent = _libc_sendfile(dst.fileno(), src.fileno(), ctypes.byref(offset),
+                                  size - offset.value)
+            if sent < 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno))
+            if sent == 0:
+                break
+    if offset.value < size: # The file was truncated while it was copied.
+        raise IOError('Could not copy %s' % src_path)
+
+
+# The magic cookie is loaded once in each process.
+_magic_cookie = None
+
+def _get_magic():
+    global _magic_cookie
+    if _magic_cookie is None:
+        _magic_cookie = magic.open(magic.MAGIC_MIME_TYPE | magic.MAGIC_NO_CHECK_TOKENS)
+        _magic_cookie.load()
+    return _magic_cookie
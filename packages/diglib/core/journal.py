@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+#
+# diglib: Personal digital document management software.
+# Copyright (C) 2011-2015 Yasser Gonzalez <yasserglez@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import time
+import sqlite3
+import threading
+
+
+class ImportJob(object):
+
+    def __init__(self, job_id, dir_path, tags, placement, walked, finished):
+        self.job_id = job_id
+        self.dir_path = dir_path
+        self.tags = tags
+        self.placement = placement
+        self.walked = walked # All the files of the directory were recorded.
+        self.finished = finished
+
+
+# Return the (size, mtime, inode) tuple of a file, or (None, None, None)
+# if the file cannot be accessed.
+def get_file_stat(path):
+    try:
+        file_stat = os.stat(path)
+    except OSError:
+        return None, None, None
+    return file_stat.st_size, file_stat.st_mtime, file_stat.st_ino
+
+
+# Journal of the imports of directories. It records the files of each
+# directory with their state and the (size, mtime, inode) tuple seen when
+# the state was recorded, so an interrupted import can be resumed without
+# going again through the files already processed.
+
+class ImportJournal(object):
+
+    # States of the files of an import job.
+    #
+    # STATE_PENDING   The file has not been processed yet.
+    # STATE_IMPORTED  The file was added to the library.
+    # STATE_REJECTED  The file was rejected by the library (e.g. duplicated).
+    # STATE_FAILED    Unexpected error while adding the file.
+    STATE_PENDING = 'pending'
+    STATE_IMPORTED = 'imported'
+    STATE_REJECTED = 'rejected'
+    STATE_FAILED = 'failed'
+
+    def __init__(self, journal_file):
+        super(ImportJournal, self).__init__()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(journal_file, check_same_thread=False)
+        self._conn.text_factory = str
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY,
+                dir_path TEXT NOT NULL,
+                tags TEXT NOT NULL,
+                placement TEXT,
+                created REAL NOT NULL,
+                walked INTEGER NOT NULL DEFAULT 0,
+                finished INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY,
+                job_id INTEGER NOT NULL REFERENCES jobs (id),
+                path TEXT NOT NULL,
+                size INTEGER,
+                mtime REAL,
+                inode INTEGER,
+                state TEXT NOT NULL,
+                result TEXT,
+                UNIQUE (job_id, path)
+            );
+            CREATE INDEX IF NOT EXISTS files_state ON files (job_id, state);
+        ''')
+        self._conn.commit()
+
+    def add_job(self, dir_path, tags, placement):
+        with self._lock:
+            cursor = self._conn.execute(
+                'INSERT INTO jobs (dir_path, tags, placement, created) VALUES (?, ?, ?, ?)',
+                (dir_path, json.dumps(sorted(tags)), placement, time.time()))
+            self._conn.commit()
+            return cursor.lastrowid
+
+    def get_job(self, job_id):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT id, dir_path, tags, placement, walked, finished '
+                'FROM jobs WHERE id = ?', (job_id, )).fetchone()
+        return self._create_job(row) if row else None
+
+    # Get the jobs importing the given directory (or all the jobs if it is
+    # None) and finished or not (or both if it is None), the most recent first.
+    def get_jobs(self, dir_path=None, finished=None):
+        sql = 'SELECT id, dir_path, tags, placement, walked, finished FROM jobs'
+        conditions = []
+        params = []
+        if dir_path is not None:
+            conditions.append('dir_path = ?')
+            params.append(dir_path)
+        if finished is not None:
+            conditions.append('finished = ?')
+            params.append(int(finished))
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        with self._lock:
+            rows = self._conn.execute(sql + ' ORDER BY id DESC', params).fetchall()
+        return [self._create_job(row) for row in rows]
+
+    def set_job_walked(self, job_id):
+        with self._lock:
+            self._conn.execute('UPDATE jobs SET walked = 1 WHERE id = ?', (job_id, ))
+            self._conn.commit()
+
+    def set_job_finished(self, job_id, finished=True):
+        with self._lock:
+            self._conn.execute('UPDATE jobs SET finished = ? WHERE id = ?',
+                               (int(finished), job_id))
+            self._conn.commit()
+
+    # Add pending files given as (path, size, mtime, inode) tuples. The
+    # files already recorded in the job are left as they are.
+    def add_files(self, job_id, files):
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR IGNORE INTO files (job_id, path, size, mtime, inode, state) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [(job_id, path, size, mtime, inode, self.STATE_PENDING)
+                 for path, size, mtime, inode in files])
+            self._conn.commit()
+
+    # Get the (path, size, mtime, inode) tuples of the files of the job in the
+    # given state, in the order they were added. At most limit files are
+    # returned if it is given.
+    def get_files(self, job_id, state, limit=None):
+        sql = ('SELECT path, size, mtime, inode FROM files '
+               'WHERE job_id = ? AND state = ? ORDER BY id')
+        params = (job_id, state)
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params += (limit, )
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    # Get a dict mapping the path of the files of the job to their recorded
+    # (size, mtime, inode) tuple. Only the given paths are looked up if any.
+    def get_file_stats(self, job_id, paths=None):
+        with self._lock:
+            if paths is None:
+                rows = self._conn.execute(
+                    'SELECT path, size, mtime, inode FROM files WHERE job_id = ?',
+                    (job_id, )).fetchall()
+            else:
+                rows = []
+                for path in paths:
+                    rows.extend(self._conn.execute(
+                        'SELECT path, size, mtime, inode FROM files '
+                        'WHERE job_id = ? AND path = ?', (job_id, path)))
+        return dict([(row[0], row[1:]) for row in rows])
+
+    # Record the state of several files in a single transaction. The files
+    # are (path, size, mtime, inode, state, result) tuples, where result is a
+    # short description (e.g. the MD5 hash of the document or the error).
+    def set_states(self, job_id, files):
+        with self._lock:
+            self._conn.executemany(
+                'UPDATE files SET size = ?, mtime = ?, inode = ?, state = ?, result = ? '
+                'WHERE job_id = ? AND path = ?',
+                [(size, mtime, inode, state, result, job_id, path)
+                 for path, size, mtime, inode, state, result in files])
+            self._conn.commit()
+
+    # Set the given files back to pending, recording their new
+    # (size, mtime, inode). The files are (path, size, mtime, inode) tuples.
+    def reset_files(self, job_id, files):
+        self.set_states(job_id, [file + (self.STATE_PENDING, None) for file in files])
+
+    # Get a dict mapping each state to the number of files of the job.
+    def get_state_counts(self, job_id):
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT state, COUNT(*) FROM files WHERE job_id = ? GROUP BY state',
+                (job_id, )).fetchall()
+        return dict(rows)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+            self._conn = None
+
+    def _create_job(self, row):
+        job_id, dir_path, tags, placement, walked, finished = row
+        return ImportJob(job_id, dir_path, set(json.loads(tags)), placement,
+                         bool(walked), bool(finished))
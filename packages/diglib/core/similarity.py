@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+#
+# diglib: Personal digital document management software.
+# Copyright (C) 2011-2015 Yasser Gonzalez <yasserglez@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import sqlite3
+import threading
+
+
+# Index of the ssdeep hashes of the documents used to find the candidates to
+# be similar to a given hash without comparing it with every other hash.
+#
+# A ssdeep hash has the form 'block_size:chunk:double_chunk', where chunk is
+# computed using block_size and double_chunk using 2 * block_size. Two hashes
+# are only compared by ssdeep if they have a chunk computed with the same
+# block size, and the comparison scores 0 unless these chunks have a common
+# substring of GRAM_SIZE characters. The index maps each (block size, gram)
+# pair to the hashes with a chunk containing the gram, so every hash that
+# could score more than 0 against a given hash is a candidate.
+
+class SimilarityIndex(object):
+
+    # Length of the common substring required by ssdeep (ROLLING_WINDOW).
+    GRAM_SIZE = 7
+
+    def __init__(self, index_file):
+        super(SimilarityIndex, self).__init__()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(index_file, check_same_thread=False)
+        self._conn.text_factory = str
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS hashes (
+                id INTEGER PRIMARY KEY,
+                hash_ssdeep TEXT NOT NULL UNIQUE
+            );
+            CREATE TABLE IF NOT EXISTS grams (
+                block_size INTEGER NOT NULL,
+                gram TEXT NOT NULL,
+                hash_id INTEGER NOT NULL REFERENCES hashes (id)
+            );
+            CREATE INDEX IF NOT EXISTS grams_gram ON grams (block_size, gram);
+            CREATE INDEX IF NOT EXISTS grams_hash_id ON grams (hash_id);
+        ''')
+        self._conn.commit()
+
+    # Add several hashes in a single transaction.
+    def add_hashes(self, hashes):
+        with self._lock:
+            for hash_ssdeep in hashes:
+                cursor = self._conn.execute(
+                    'INSERT OR IGNORE INTO hashes (hash_ssdeep) VALUES (?)',
+                    (hash_ssdeep, ))
+                if cursor.rowcount: # The hash was not in the index.
+                    hash_id = cursor.lastrowid
+                    self._conn.executemany(
+                        'INSERT INTO grams (block_size, gram, hash_id) VALUES (?, ?, ?)',
+                        [(block_size, gram, hash_id)
+                         for block_size, gram in self._get_grams(hash_ssdeep)])
+            self._conn.commit()
+
+    def delete_hash(self, hash_ssdeep):
+        self.delete_hashes([hash_ssdeep])
+
+    # Delete several hashes in a single transaction.
+    def delete_hashes(self, hashes):
+        with self._lock:
+            for hash_ssdeep in hashes:
+                row = self._conn.execute('SELECT id FROM hashes WHERE hash_ssdeep = ?',
+                                         (hash_ssdeep, )).fetchone()
+                if row:
+                    self._conn.execute('DELETE FROM grams WHERE hash_id = ?', row)
+                    self._conn.execute('DELETE FROM hashes WHERE id = ?', row)
+            self._conn.commit()
+
+    # Get the hashes that could be similar to the given hash.
+    def get_candidates(self, hash_ssdeep):
+        grams = {}
+        for block_size, gram in self._get_grams(hash_ssdeep):
+            grams.setdefault(block_size, []).append(gram)
+        if not grams:
+            return []
+        conditions = []
+        params = []
+        for block_size, block_grams in grams.iteritems():
+            conditions.append('(block_size = ? AND gram IN (%s))' %
+                              ', '.join('?' * len(block_grams)))
+            params.append(block_size)
+            params.extend(block_grams)
+        where = ' OR '.join(conditions)
+        with self._lock:
+            cursor = self._conn.execute(
+                'SELECT hash_ssdeep FROM hashes WHERE id IN '
+                '(SELECT hash_id FROM grams WHERE %s)' % where, params)
+            return [row[0] for row in cursor]
+
+    def get_hash_count(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM hashes').fetchone()[0]
+
+    # Replace the contents of the index with the given hashes.
+    def rebuild(self, hashes):
+        with self._lock:
+            self._conn.execute('DELETE FROM grams')
+            self._conn.execute('DELETE FROM hashes')
+            self._conn.commit()
+        self.add_hashes(hashes)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+            self._conn = None
+
+    # Return the set of (block size, gram) pairs of a hash. Chunks shorter
+    # than GRAM_SIZE are used as a single gram (ssdeep only gives them a
+    # score if they are identical).
+    def _get_grams(self, hash_ssdeep):
+        block_size, chunk, double_chunk = hash_ssdeep.split(':', 2)
+        block_size = int(block_size)
+        grams = set()
+        for size, chunk in ((block_size, chunk), (2 * block_size, double_chunk)):
+            chunk = _SEQUENCES_RE.sub(r'\1\1\1', chunk)
+            if len(chunk) < self.GRAM_SIZE:
+                if chunk:
+                    grams.add((size, chunk))
+            else:
+                for i in xrange(len(chunk) - self.GRAM_SIZE + 1):
+                    grams.add((size, chunk[i:i + self.GRAM_SIZE]))
+        return grams
+
+
+# ssdeep reduces sequences of more than three identical characters
+# to three characters before comparing the chunks.
+_SEQUENCES_RE = re.compile(r'(.)\1{3,}')
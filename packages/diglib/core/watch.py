@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+#
+# diglib: Personal digital document management software.
+# Copyright (C) 2011-2015 Yasser Gonzalez <yasserglez@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import threading
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None # The directory is polled.
+
+
+# Watch the directory of an import job (see DigitalLibrary.start_import) and
+# import the files as they are written to it. The journal of the import job
+# is the manifest of the files already seen, so the files are only read if
+# they are new or their size, modification time or inode changed.
+#
+# The directory is watched using inotify if pyinotify is available, importing
+# the files once they are closed after writing them or moved to the directory.
+# Otherwise the directory is walked every poll_interval seconds and the files
+# modified in the last settle_time seconds are left for the next walk. When
+# inotify is used the directory is walked when the watcher starts and when
+# events are lost, and once more settle_time seconds later to find the files
+# closed just before the walk (they are not reported again).
+
+class DirectoryWatcher(object):
+
+    POLL_INTERVAL = 10
+    SETTLE_TIME = 5
+
+    def __init__(self, library, job_id, batch_size=100, use_inotify=True,
+                 poll_interval=POLL_INTERVAL, settle_time=SETTLE_TIME):
+        super(DirectoryWatcher, self).__init__()
+        self._library = library
+        self._job_id = job_id
+        self._batch_size = batch_size
+        self._use_inotify = use_inotify and pyinotify is not None
+        self._poll_interval = poll_interval
+        self._settle_time = settle_time
+        self._stopped = threading.Event()
+        # Paths reported by inotify since the last update of the import job,
+        # or None if the whole directory should be walked again.
+        self._event_paths = set()
+        # Time of the next walk of the directory when inotify is used.
+        self._walk_time = None
+
+    # Import the files of the directory until stop is called. The callback
+    # (if given) is called with the (doc_path, result) tuples of resume_import.
+    def run(self, callback=None):
+        self._stopped.clear()
+        notifier = self._create_notifier() if self._use_inotify else None
+        try:
+            # Files written while the directory was not being watched.
+            self._event_paths = set()
+            self._walk_dir()
+            while not self._stopped.is_set():
+                self._import_docs(callback)
+                if notifier is None:
+                    self._stopped.wait(self._poll_interval)
+                    if not self._stopped.is_set():
+                        self._library.update_import(self._job_id,
+                                                    min_age=self._settle_time)
+                else:
+                    self._wait_events(notifier)
+        finally:
+            if notifier is not None:
+                notifier.stop()
+
+    # Stop the watcher. It can be called from another thread (e.g. a signal
+    # handler) and run returns after the document being added (if any).
+    def stop(self):
+        self._stopped.set()
+
+    def _import_docs(self, callback):
+        results = self._library.resume_import(self._job_id, self._batch_size)
+        try:
+            for doc_path, result in results:
+                if callback is not None:
+                    callback(doc_path, result)
+                if self._stopped.is_set():
+                    break
+        finally:
+            results.close()
+
+    def _create_notifier(self):
+        dir_path = self._library.get_import_job(self._job_id).dir_path
+        watch_manager = pyinotify.WatchManager()
+        notifier = pyinotify.Notifier(watch_manager, self._on_event)
+        mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_CREATE
+        watch_manager.add_watch(dir_path, mask, rec=True, auto_add=True)
+        return notifier
+
+    # Record the files of the directory in the import job, and schedule
+    # another walk (when inotify is used) for the files left by this one.
+    def _walk_dir(self):
+        self._library.update_import(self._job_id, min_age=self._settle_time)
+        self._walk_time = time.time() + self._settle_time
+
+    # Wait for inotify events (at most poll_interval seconds, so stop is
+    # noticed, or until the scheduled walk) and record the reported files
+    # in the import job.
+    def _wait_events(self, notifier):
+        timeout = self._poll_interval
+        if self._walk_time is not None:
+            timeout = max(0, min(timeout, self._walk_time - time.time()))
+        if notifier.check_events(int(1000 * timeout)):
+            notifier.read_events()
+            notifier.process_events()
+        event_paths = self._event_paths
+        self._event_paths = set()
+        if event_paths is None:
+            self._walk_dir()
+            return
+        if event_paths:
+            self._library.update_import(self._job_id, event_paths)
+        if self._walk_time is not None and time.time() >= self._walk_time:
+            self._walk_time = None
+            self._library.update_import(self._job_id, min_age=self._settle_time)
+
+    def _on_event(self, event):
+        if self._event_paths is None:
+            return
+        if event.mask & pyinotify.IN_Q_OVERFLOW or event.dir:
+            # Events were lost, or a directory was created or moved to the
+            # watched directory (its files are not reported).
+            self._event_paths = None
+        elif event.mask & (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO):
+            self._event_paths.add(event.pathname)
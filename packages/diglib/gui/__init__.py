@@ -17,6 +17,7 @@
 # with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import gtk
+import gobject
 
 from diglib.gui.util import get_image
 from diglib.gui.mainwindow import MainWindow
@@ -26,6 +27,7 @@ class GUI(object):
 
     def __init__(self, library):
         super(GUI, self).__init__()
+        gobject.threads_init() # The library calls back from other threads.
         self._init_icons()
         self._main_window = MainWindow(library)
 
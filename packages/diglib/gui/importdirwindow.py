@@ -17,6 +17,7 @@
 # with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import itertools
 
 import gtk
 import gobject
@@ -32,6 +33,9 @@ class ImportDirectoryWindow(XMLWidget):
     TREEVIEW_COLUMN_PATH = 1
     TREEVIEW_COLUMN_RESULT = 2
 
+    # Number of documents imported on each iteration of the main loop.
+    IMPORT_BATCH_SIZE = 10
+
     def __init__(self, library):
         super(ImportDirectoryWindow, self).__init__('import_dir_window')
         # Instance attributes for widgets.
@@ -48,8 +52,9 @@ class ImportDirectoryWindow(XMLWidget):
         # Other instance attributes.
         self._library = library
         self._exit = False
-        self._doc_paths = None
-        self._doc_tags = None
+        self._job_id = None
+        self._import_results = None
+        self._delete_docs = False
         # Initialize widgets.
         self._init_treeview()
 
@@ -69,60 +74,89 @@ class ImportDirectoryWindow(XMLWidget):
         self._import_dir_window.connect('destroy', self.on_import_dir_window_destroy)
         while not self._exit:
             gtk.main_iteration(True)
-        return gtk.RESPONSE_CANCEL if (self._doc_paths is None) else gtk.RESPONSE_OK
+        return gtk.RESPONSE_CANCEL if (self._job_id is None) else gtk.RESPONSE_OK
 
     def on_import_dir_window_destroy(self, widget):
         self._exit = True
 
     def on_import_button_clicked(self, button):
         dir_path = self._filechooserbutton.get_filename()
-        self._doc_tags = tags_from_text(self._tags_entry.get_text())
+        doc_tags = tags_from_text(self._tags_entry.get_text())
+        # The library removes the documents successfully imported.
+        placement = self._library.PLACEMENT_MOVE \
+            if self._delete_checkbutton.get_active() else None
+        # Continue the last import of the directory if it was interrupted (e.g.
+        # the application was closed). If it was started with other tags or
+        # placement method the user chooses between continuing it with them
+        # or starting a new import. The files added or changed since then are
+        # also imported.
+        jobs = self._library.get_import_jobs(dir_path)
+        if jobs and not self._library.import_job_matches(jobs[0].job_id,
+                                                         doc_tags, placement):
+            if not self._confirm_resume():
+                jobs = []
         # Disable all widgets but the ones reporting progress.
         self._table.set_sensitive(False)
         self._progress_vbox.set_sensitive(True)
         self._hbuttonbox.set_sensitive(False)
         self._delete_checkbutton.set_sensitive(False)
-        # Generating the list of documents to be imported.
-        self._doc_paths = []
-        for dirpath, _, filenames in os.walk(dir_path):
-            self._doc_paths.extend([os.path.join(dirpath, name) for name in filenames])
-        self._total_docs = len(self._doc_paths)
-        self._progressbar.set_fraction(0)
-        self._progressbar.set_text('Importing document %s of %s' % (1, self._total_docs))
+        if jobs:
+            self._job_id = jobs[0].job_id
+            self._library.update_import(self._job_id)
+            self._delete_docs = jobs[0].placement == self._library.PLACEMENT_MOVE
+        else:
+            self._job_id = self._library.start_import(dir_path, doc_tags, placement)
+            self._delete_docs = placement is not None
+        self._import_results = self._library.resume_import(self._job_id,
+                                                           self.IMPORT_BATCH_SIZE)
+        current_doc, total_docs = self._library.get_import_progress(self._job_id)
+        self._progressbar.set_fraction(current_doc / float(max(total_docs, 1)))
+        self._progressbar.set_text('Importing document %s of %s' %
+                                   (min(current_doc + 1, total_docs), total_docs))
         gobject.idle_add(self._import_docs)
 
     def on_cancel_button_clicked(self, button):
         self.destroy()
 
+    def _confirm_resume(self):
+        dialog = gtk.MessageDialog(self._import_dir_window, gtk.DIALOG_MODAL,
+                                   gtk.MESSAGE_QUESTION, gtk.BUTTONS_YES_NO,
+                                   'Continue the interrupted import of the directory?')
+        dialog.format_secondary_text('It was started with other tags or options, '
+                                     'which will be used for the remaining files. '
+                                     'Otherwise a new import is started with the '
+                                     'current ones.')
+        response = dialog.run()
+        dialog.destroy()
+        return response == gtk.RESPONSE_YES
+
     def _import_docs(self):
-        if not self._doc_paths:
+        # The results of a batch of documents (recorded in the import journal).
+        results = list(itertools.islice(self._import_results, self.IMPORT_BATCH_SIZE))
+        if not results:
             self._progressbar.set_fraction(1.0)
             self._progressbar.set_text('Completed')
             return False # Finished importing documents.
-        doc_path = self._doc_paths.pop()
-        current_doc = self._total_docs - len(self._doc_paths)
-        self._progressbar.set_fraction(current_doc / float(self._total_docs))
+        current_doc, total_docs = self._library.get_import_progress(self._job_id)
+        self._progressbar.set_fraction(current_doc / float(total_docs))
         self._progressbar.set_text('Importing document %s of %s' %
-                                   (current_doc + 1, self._total_docs))
-        try:
-            self._library.add_doc(doc_path, self._doc_tags)
-        except error.DocumentDuplicatedExact:
-            result = 'The document is already in the library.'
-            if self._delete_checkbutton.get_active():
-                os.remove(doc_path)
-        except error.DocumentDuplicatedSimilar:
-            result = 'A similar document is already in the library.'
-        except error.DocumentNotRetrievable:
-            result = 'The document is not retrievable.'
-        except error.DocumentNotSupported:
-            result = 'The format of the document not supported.'
-        except:
-            result = 'Unexpected error.'
-        else:
-            result = 'The document was imported.'
-            if self._delete_checkbutton.get_active():
-                os.remove(doc_path)
-        self._liststore.append([os.path.basename(doc_path), doc_path, result])
+                                   (current_doc, total_docs))
+        for doc_path, result in results:
+            if isinstance(result, error.DocumentDuplicatedExact):
+                message = 'The document is already in the library.'
+                if self._delete_docs:
+                    os.remove(doc_path)
+            elif isinstance(result, error.DocumentDuplicatedSimilar):
+                message = 'A similar document is already in the library.'
+            elif isinstance(result, error.DocumentNotRetrievable):
+                message = 'The document is not retrievable.'
+            elif isinstance(result, error.DocumentNotSupported):
+                message = 'The format of the document not supported.'
+            elif isinstance(result, Exception):
+                message = 'Unexpected error.'
+            else:
+                message = 'The document was imported.'
+            self._liststore.append([os.path.basename(doc_path), doc_path, message])
         # Make the last row visible.
         last_path = (len(self._liststore) - 1, )
         self._treeview.scroll_to_cell(last_path)
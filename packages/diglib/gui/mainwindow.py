@@ -17,6 +17,7 @@
 # with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import urllib
+import itertools
 
 import gtk
 import gobject
@@ -205,13 +206,12 @@ class MainWindow(XMLWidget):
             self._update_tags_treeview(True)
 
     def on_open_docs(self, *args):
-        for hash_md5 in self._iter_selected_docs():
-            doc = self._library.get_doc(hash_md5)
+        for doc in self._library.get_docs(self._iter_selected_docs()):
             open_file(doc.document_abspath)
 
     def on_copy_docs(self, *args):
-        doc_paths = [self._library.get_doc(hash_md5).document_abspath
-                     for hash_md5 in self._iter_selected_docs()]
+        doc_paths = [doc.document_abspath for doc in
+                     self._library.get_docs(self._iter_selected_docs())]
         if doc_paths:
             def get_func(clipboard, selectiondata, info, data):
                 uris = ['file://%s' % urllib.quote(path) for path in doc_paths]
@@ -240,14 +240,14 @@ class MainWindow(XMLWidget):
                 # Stop the current query (if any).
                 if self._update_docs_iconview_id > 0:
                     gobject.source_remove(self._update_docs_iconview_id)
-                for hash_md5 in selected_docs:
-                    self._library.delete_doc(hash_md5)
+                self._library.delete_docs(selected_docs)
                 self._update_tags_treeview(True)
 
     def on_tag_docs(self, *args):
         common_tags = None
-        for hash_md5 in self._iter_selected_docs():
-            doc_tags = self._library.get_doc(hash_md5).tags
+        selected_docs = self._library.get_docs(self._iter_selected_docs())
+        for doc in selected_docs:
+            doc_tags = doc.tags
             common_tags = doc_tags if common_tags is None \
                 else doc_tags.intersection(common_tags)
         dialog = EditTagsDialog(common_tags)
@@ -260,12 +260,14 @@ class MainWindow(XMLWidget):
                 gobject.source_remove(self._update_docs_iconview_id)
             removed_tags = common_tags.difference(edited_tags)
             added_tags = edited_tags.difference(common_tags)
+            doc_tags = {}
+            for doc in selected_docs:
+                tags = set(doc.tags)
+                tags.difference_update(removed_tags)
+                tags.update(added_tags)
+                doc_tags[doc.hash_md5] = tags
             try:
-                for hash_md5 in self._iter_selected_docs():
-                    doc_tags = self._library.get_doc(hash_md5).tags
-                    doc_tags.difference_update(removed_tags)
-                    doc_tags.update(added_tags)
-                    self._library.update_tags(hash_md5, doc_tags)
+                self._library.update_tags_bulk(doc_tags)
             except error.DocumentNotRetrievable:
                 message = 'Could not remove a tag from a document.'
                 secondary_text = 'If the tag is removed, the ' \
@@ -390,57 +392,74 @@ class MainWindow(XMLWidget):
             if self._update_docs_iconview_id > 0:
                 gobject.source_remove(self._update_docs_iconview_id)
             self._docs_liststore.clear()
+            results = self._library.search_results(self._query, self._selected_tags)
+            if results.matches_lower_bound == results.matches_upper_bound:
+                self._statusbar.push(0, self._format_docs_count(results.matches_estimated))
+            else:
+                self._statusbar.push(0, 'About %s' %
+                                     self._format_docs_count(results.matches_estimated))
             self._update_docs_iconview_id = \
-                gobject.idle_add(self._update_docs_iconview,
-                                 self._query, self._selected_tags)
+                gobject.idle_add(self._update_docs_iconview, iter(results))
 
-    def _update_docs_iconview(self, query, selected_tags):
-        self._statusbar.push(0, 'Loading documents...')
+    # Add the next 10 results of the search to the icon view.
+    def _update_docs_iconview(self, results):
         start = len(self._docs_liststore)
-        results = self._library.search(query, selected_tags, start, 10)
-        if not results:
-            num_docs = len(self._docs_liststore)
-            text = '%s %s' % (num_docs, 'documents' if num_docs > 1 else 'document')
-            self._statusbar.push(0, text)
+        hash_list = list(itertools.islice(results, 10))
+        if not hash_list:
+            self._statusbar.push(0, self._format_docs_count(len(self._docs_liststore)))
             self._update_docs_iconview_id = 0
             return False # Finished getting results.
         load_pixbuf = start <= 40 # Load the pixbuf of the first 50 documents.
-        for hash_md5 in results:
-            doc = self._library.get_doc(hash_md5)
-            if self._docs_icon_size == self.DOC_ICON_SMALL:
-                icon_path = doc.small_thumbnail_abspath \
-                    if doc.small_thumbnail_abspath else ''
-                if icon_path and load_pixbuf:
-                    icon_pixbuf = gtk.gdk.pixbuf_new_from_file(icon_path)
-                else:
-                    icon_pixbuf = self._docs_icon_small
-            elif self._docs_icon_size == self.DOC_ICON_NORMAL:
-                icon_path = doc.normal_thumbnail_abspath \
-                    if doc.normal_thumbnail_abspath else ''
-                if icon_path and load_pixbuf:
-                    icon_pixbuf = gtk.gdk.pixbuf_new_from_file(icon_path)
-                else:
-                    icon_pixbuf = self._docs_icon_normal
-            elif self._docs_icon_size == self.DOC_ICON_LARGE:
-                icon_path = doc.large_thumbnail_abspath \
-                    if doc.large_thumbnail_abspath else ''
-                if icon_path and load_pixbuf:
-                    icon_pixbuf = gtk.gdk.pixbuf_new_from_file(icon_path)
-                else:
-                    icon_pixbuf = self._docs_icon_large
+        for doc in self._library.get_docs(hash_list):
+            icon_path = self._get_doc_icon_path(doc)
+            if icon_path and load_pixbuf:
+                icon_pixbuf = gtk.gdk.pixbuf_new_from_file(icon_path)
+            else:
+                icon_pixbuf = self._get_default_doc_icon()
             self._docs_liststore.append([doc.hash_md5, icon_path, icon_pixbuf])
+            if doc.thumbnails_pending:
+                # Show the default icon until the thumbnails are generated.
+                self._library.request_thumbnails(doc.hash_md5, self._thumbnails_callback)
         return True # Continue getting results.
 
+    # Called by the library (from another thread) when
+    # the thumbnails of a document are generated.
+    def _thumbnails_callback(self, doc):
+        gobject.idle_add(self._update_doc_icon, doc)
+
+    def _update_doc_icon(self, doc):
+        icon_path = self._get_doc_icon_path(doc)
+        for row in self._docs_liststore:
+            if row[self.DOCS_TREEVIEW_COLUMN_ID] == doc.hash_md5:
+                row[self.DOCS_TREEVIEW_COLUMN_ICON_PATH] = icon_path
+                if icon_path:
+                    row[self.DOCS_TREEVIEW_COLUMN_ICON_PIXBUF] = \
+                        gtk.gdk.pixbuf_new_from_file(icon_path)
+                break
+        return False # Do not call again.
+
+    def _get_doc_icon_path(self, doc):
+        if self._docs_icon_size == self.DOC_ICON_SMALL:
+            icon_path = doc.small_thumbnail_abspath
+        elif self._docs_icon_size == self.DOC_ICON_NORMAL:
+            icon_path = doc.normal_thumbnail_abspath
+        elif self._docs_icon_size == self.DOC_ICON_LARGE:
+            icon_path = doc.large_thumbnail_abspath
+        return icon_path if icon_path else ''
+
+    def _get_default_doc_icon(self):
+        if self._docs_icon_size == self.DOC_ICON_SMALL:
+            return self._docs_icon_small
+        elif self._docs_icon_size == self.DOC_ICON_NORMAL:
+            return self._docs_icon_normal
+        elif self._docs_icon_size == self.DOC_ICON_LARGE:
+            return self._docs_icon_large
+
     def _update_docs_iconview_icons(self, model, path, iter, visible_range):
         start_path, end_path = visible_range
         icon_path = model.get_value(iter, self.DOCS_TREEVIEW_COLUMN_ICON_PATH)
         if not icon_path or path < start_path or path > end_path:
-            if self._docs_icon_size == self.DOC_ICON_SMALL:
-                icon_pixbuf = self._docs_icon_small
-            elif self._docs_icon_size == self.DOC_ICON_NORMAL:
-                icon_pixbuf = self._docs_icon_normal
-            elif self._docs_icon_size == self.DOC_ICON_LARGE:
-                icon_pixbuf = self._docs_icon_large
+            icon_pixbuf = self._get_default_doc_icon()
         else:
             icon_pixbuf = gtk.gdk.pixbuf_new_from_file(icon_path)
         model.set_value(iter, self.DOCS_TREEVIEW_COLUMN_ICON_PIXBUF, icon_pixbuf)
@@ -478,6 +497,9 @@ class MainWindow(XMLWidget):
         self._search_timeout_id = 0
         self._update_docs_iconview_wrapper()
 
+    def _format_docs_count(self, num_docs):
+        return '%s %s' % (num_docs, 'document' if num_docs == 1 else 'documents')
+
     def _iter_selected_docs(self):
         paths = self._docs_iconview.get_selected_items()
         for path in paths:
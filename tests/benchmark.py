@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import random
+import shutil
+import string
+import resource
+import tempfile
+import multiprocessing
+
+import ssdeep
+
+# Allow running this script in source directory.
+src_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+if os.path.isfile(os.path.join(src_dir, 'setup.py')):
+    sys.path.insert(0, os.path.normpath(os.path.join(src_dir, 'packages')))
+
+from diglib.core import Document, LibraryPaths
+from diglib.core.index import XapianIndex
+from diglib.core.database import SQLAlchemyDatabase, SQLiteDatabase
+from diglib.core.similarity import SimilarityIndex
+
+
+# Alphabet of the chunks of the ssdeep hashes.
+SSDEEP_ALPHABET = string.ascii_letters + string.digits + '+/'
+
+
+def random_ssdeep_hash(rand):
+    block_size = 3 * 2 ** rand.randint(4, 14)
+    chunk = ''.join(rand.choice(SSDEEP_ALPHABET) for _ in xrange(rand.randint(32, 64)))
+    double_chunk = ''.join(rand.choice(SSDEEP_ALPHABET) for _ in xrange(rand.randint(16, 32)))
+    return '%s:%s:%s' % (block_size, chunk, double_chunk)
+
+
+# Hash of a slightly modified version of the document with the given hash.
+def similar_ssdeep_hash(rand, hash_ssdeep):
+    block_size, chunk, double_chunk = hash_ssdeep.split(':')
+    chunk = list(chunk)
+    chunk[rand.randrange(len(chunk))] = rand.choice(SSDEEP_ALPHABET)
+    return '%s:%s:%s' % (block_size, ''.join(chunk), double_chunk)
+
+
+def random_tags(rand):
+    return set(u'tag%d' % rand.randrange(100) for _ in xrange(rand.randint(1, 5)))
+
+
+def random_doc(rand):
+    hash_md5 = '%032x' % rand.getrandbits(128)
+    return Document(hash_md5, random_ssdeep_hash(rand), 'application/pdf',
+                    hash_md5 + '.pdf', rand.randint(1000, 10 ** 7), None, None,
+                    None, 'en', random_tags(rand))
+
+
+# Average time (in milliseconds) of calling func with each of the arguments.
+def timeit(func, args):
+    start = time.time()
+    for arg in args:
+        func(arg)
+    return 1000 * (time.time() - start) / len(args)
+
+
+# Cost of looking for similar documents when a document is imported, comparing
+# the new hash with every hash in the library (the cost of the size-range scan
+# in the worst case) and only with the candidates given by SimilarityIndex.
+def benchmark_similarity(sizes=(1000, 10000, 100000), num_queries=100):
+    rand = random.Random(0)
+    temp_dir = tempfile.mkdtemp()
+    try:
+        index = SimilarityIndex(os.path.join(temp_dir, 'similarity.db'))
+        hashes = []
+        print '%10s %12s %12s %12s' % ('documents', 'scan (ms)', 'index (ms)', 'candidates')
+        for size in sizes:
+            new_hashes = [random_ssdeep_hash(rand) for _ in xrange(size - len(hashes))]
+            index.add_hashes(new_hashes)
+            hashes.extend(new_hashes)
+            # Half of the imported documents are similar to a document in the library.
+            queries = [random_ssdeep_hash(rand) for _ in xrange(num_queries / 2)]
+            queries.extend([similar_ssdeep_hash(rand, rand.choice(hashes))
+                            for _ in xrange(num_queries - len(queries))])
+            def scan(hash_ssdeep):
+                for other_hash_ssdeep in hashes:
+                    ssdeep.compare(hash_ssdeep, other_hash_ssdeep)
+            def lookup(hash_ssdeep):
+                for other_hash_ssdeep in index.get_candidates(hash_ssdeep):
+                    ssdeep.compare(hash_ssdeep, other_hash_ssdeep)
+            candidates = sum(len(index.get_candidates(q)) for q in queries)
+            print '%10d %12.3f %12.3f %12.2f' % \
+                (size, timeit(scan, queries[:10]), timeit(lookup, queries),
+                 candidates / float(num_queries))
+        index.close()
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+# Cost of the most frequent operations of the Database classes: adding a
+# document, looking up a document, a page of 50 documents (get_docs),
+# updating the tags of a document and counting the documents of each tag.
+def benchmark_database(num_docs=10000, num_queries=1000):
+    print '%20s %12s %12s %12s %12s %12s' % \
+        ('class', 'add_doc', 'get_doc', 'get_docs', 'update_tags', 'tag_counts')
+    for database_class in (SQLAlchemyDatabase, SQLiteDatabase):
+        rand = random.Random(0)
+        temp_dir = tempfile.mkdtemp()
+        try:
+            database = database_class(os.path.join(temp_dir, 'database.db'))
+            docs = [random_doc(rand) for _ in xrange(num_docs)]
+            database.add_docs(docs[:-num_queries])
+            add_doc = timeit(database.add_doc, docs[-num_queries:])
+            hashes = [rand.choice(docs).hash_md5 for _ in xrange(num_queries)]
+            get_doc = timeit(database.get_doc, hashes)
+            pages = [hashes[i:i + 50] for i in xrange(0, len(hashes), 50)]
+            get_docs = timeit(database.get_docs, pages)
+            update_tags = timeit(lambda hash_md5: database.update_tags(hash_md5, random_tags(rand)),
+                                 hashes)
+            tag_counts = timeit(lambda _: database.get_all_tag_counts(), xrange(10))
+            print '%20s %12.3f %12.3f %12.3f %12.3f %12.3f' % \
+                (database_class.__name__, add_doc, get_doc, get_docs, update_tags, tag_counts)
+            database.close()
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+# Document keeping its attributes (and the directories of the library)
+# in an instance dict, as Document did before using slots.
+class DictDocument(object):
+
+    def __init__(self, hash_md5, hash_ssdeep, mime_type, document_path,
+                 document_size, small_thumbnail_path, normal_thumbnail_path,
+                 large_thumbnail_path, language_code, tags):
+        self.hash_md5 = hash_md5
+        self.hash_ssdeep = hash_ssdeep
+        self.mime_type = mime_type
+        self._documents_dir = None
+        self.document_path = document_path
+        self.document_size = document_size
+        self._thumbnails_dir = None
+        self.small_thumbnail_path = small_thumbnail_path
+        self.normal_thumbnail_path = normal_thumbnail_path
+        self.large_thumbnail_path = large_thumbnail_path
+        self.language_code = language_code
+        self.tags = tags
+
+
+# Create num_docs documents of the given class (sharing the strings of the
+# given values, like the rows returned by the database) and put in the
+# queue the growth of the maximum resident set size of the process in KiB.
+def create_docs(doc_class, values, num_docs, queue):
+    paths = LibraryPaths('/library/documents', '/library/thumbnails')
+    start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    docs = []
+    for i in xrange(num_docs):
+        args = values[i % len(values)]
+        doc = doc_class(*(args[:-1] + (set(args[-1]), )))
+        if doc_class is Document:
+            doc.set_paths(paths)
+        else:
+            doc._documents_dir = paths.documents_dir
+            doc._thumbnails_dir = paths.thumbnails_dir
+        docs.append(doc)
+    queue.put(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start)
+
+
+# Memory used by num_docs documents in memory (e.g. all the results of a
+# search), with Document and with documents using an instance dict. Each
+# class is measured in a new process.
+def benchmark_documents(num_docs=1000000, num_values=1000):
+    rand = random.Random(0)
+    values = []
+    for _ in xrange(num_values):
+        doc = random_doc(rand)
+        values.append((doc.hash_md5, doc.hash_ssdeep, doc.mime_type, doc.document_path,
+                       doc.document_size, doc.small_thumbnail_path,
+                       doc.normal_thumbnail_path, doc.large_thumbnail_path,
+                       doc.language_code, doc.tags))
+    print '%20s %12s %12s' % ('class', 'total (MiB)', 'doc (bytes)')
+    for doc_class in (DictDocument, Document):
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=create_docs,
+                                          args=(doc_class, values, num_docs, queue))
+        process.start()
+        memory = queue.get()
+        process.join()
+        print '%20s %12.1f %12.1f' % \
+            (doc_class.__name__, memory / 1024.0, 1024.0 * memory / num_docs)
+
+
+# Cost of parsing the queries typed in the search entry (each prefix of the
+# query is searched): creating the parsers for each query, reusing the
+# parsers of the index, and looking up the query in the cache of the index.
+def benchmark_query_parsing(query=u'personal digital document management -draft',
+                            repeat=20):
+    temp_dir = tempfile.mkdtemp()
+    try:
+        index = XapianIndex(os.path.join(temp_dir, 'index'))
+        queries = [query[:i] for i in xrange(1, len(query) + 1)] * repeat
+        reader = index._get_reader()
+        def create_parsers(query):
+            index._create_parsers()
+            index._create_query(query, index.QUERY_FLAGS, None, reader)
+        def reuse_parsers(query):
+            index._create_query(query, index.QUERY_FLAGS, None, reader)
+        print '%12s %12s %12s' % ('new (ms)', 'reused (ms)', 'cached (ms)')
+        print '%12.3f %12.3f %12.3f' % \
+            (timeit(create_parsers, queries), timeit(reuse_parsers, queries),
+             timeit(index._parse_query, queries))
+        index.close()
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+BENCHMARKS = {
+    'similarity': benchmark_similarity,
+    'database': benchmark_database,
+    'documents': benchmark_documents,
+    'query_parsing': benchmark_query_parsing,
+}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or sorted(BENCHMARKS.keys())
+    for name in names:
+        print '== %s ==' % name
+        BENCHMARKS[name]()
@@ -3,8 +3,17 @@
 
 import os
 import sys
+import time
 import shutil
+import sqlite3
+import hashlib
 import unittest
+import threading
+import multiprocessing
+
+import ssdeep
+import xapian
+import PIL.Image
 
 # Allow running this script in source directory.
 src_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
@@ -13,15 +22,28 @@ if os.path.isfile(os.path.join(src_dir, 'setup.py')):
 
 from diglib.core import DigitalLibrary, error
 from diglib.core.index import XapianIndex
-from diglib.core.database import SQLAlchemyDatabase
+from diglib.core.database import SQLAlchemyDatabase, SQLiteDatabase, SQLITE_MIGRATIONS
+from diglib.core import ingest, watch
+from diglib.core.watch import DirectoryWatcher
+
+
+# Fake scanner writing the documents to the directory (each document is
+# written to tmp_dir and then moved to the directory).
+def scan_docs(doc_paths, dir_path, tmp_dir):
+    for doc_path in doc_paths:
+        tmp_path = os.path.join(tmp_dir, os.path.basename(doc_path))
+        shutil.copy(doc_path, tmp_path)
+        os.rename(tmp_path, os.path.join(dir_path, os.path.basename(doc_path)))
 
 
 class TestDigitalLibrary(unittest.TestCase):
 
+    DATABASE_CLASS = SQLAlchemyDatabase
+
     def setUp(self):
         self._tests_dir = os.path.dirname(os.path.abspath(__file__))
         self._library_dir = os.path.join(self._tests_dir, 'data')
-        self._library = DigitalLibrary(self._library_dir, XapianIndex, SQLAlchemyDatabase)
+        self._library = DigitalLibrary(self._library_dir, XapianIndex, self.DATABASE_CLASS)
 
     def tearDown(self):
         self._library.close()
@@ -87,6 +109,59 @@ class TestDigitalLibrary(unittest.TestCase):
         self._assert_docs_equal(doc, other_doc)
         return doc
 
+    def test_add_doc_thumbnail_sizes(self):
+        for name in ('en.pdf', 'en.djvu', 'en.ps'):
+            doc = self._library.add_doc(os.path.join(self._tests_dir, name), set())
+            for path, size in ((doc.small_thumbnail_abspath, DigitalLibrary.THUMBNAIL_SIZE_SMALL),
+                               (doc.normal_thumbnail_abspath, DigitalLibrary.THUMBNAIL_SIZE_NORMAL),
+                               (doc.large_thumbnail_abspath, DigitalLibrary.THUMBNAIL_SIZE_LARGE)):
+                image = PIL.Image.open(path)
+                self.assertEqual(image.format, 'PNG')
+                self.assertLessEqual(max(image.size), size)
+
+    def test_add_doc_defer_thumbnails(self):
+        self._library.close()
+        self._library = DigitalLibrary(self._library_dir, XapianIndex,
+                                       self.DATABASE_CLASS, defer_thumbnails=True)
+        pdf_path = os.path.join(self._tests_dir, 'en.pdf')
+        doc = self._library.add_doc(pdf_path, set('ab'))
+        ready = threading.Event()
+        docs = []
+        def callback(doc):
+            docs.append(doc)
+            ready.set()
+        if self._library.request_thumbnails(doc.hash_md5, callback):
+            self.assertTrue(doc.thumbnails_pending)
+            self.assertFalse(doc.large_thumbnail_abspath)
+            ready.wait(60)
+            doc = docs[0]
+        self.assertFalse(doc.thumbnails_pending)
+        self.assertTrue(os.path.isfile(doc.small_thumbnail_abspath))
+        self.assertTrue(os.path.isfile(doc.normal_thumbnail_abspath))
+        self.assertTrue(os.path.isfile(doc.large_thumbnail_abspath))
+        self._assert_docs_equal(doc, self._library.get_doc(doc.hash_md5))
+        self.assertFalse(self._library.request_thumbnails(doc.hash_md5))
+
+    def test_add_doc_defer_thumbnails_failed(self):
+        self._library.close()
+        self._library = DigitalLibrary(self._library_dir, XapianIndex,
+                                       self.DATABASE_CLASS, defer_thumbnails=True)
+        pdf_path = os.path.join(self._tests_dir, 'en.pdf')
+        doc = self._library.add_doc(pdf_path, set('ab'))
+        # Not rendered, so they are generated again when requested.
+        self._library._store_thumbnails(doc.hash_md5, None)
+        self.assertTrue(self._library.get_doc(doc.hash_md5).thumbnails_pending)
+        # The thumbnails written are removed if the database is not updated.
+        def update_thumbnails(*args):
+            raise IOError()
+        self._library._database.update_thumbnails = update_thumbnails
+        thumbnails = {DigitalLibrary.THUMBNAIL_SIZE_SMALL: 'PNG'}
+        self._library._store_thumbnails(doc.hash_md5, thumbnails)
+        self.assertTrue(self._library.get_doc(doc.hash_md5).thumbnails_pending)
+        thumbnail_path = os.path.join(self._library_dir, 'thumbnails', 'small',
+                                      self._library._get_path(doc.hash_md5) + '.png')
+        self.assertFalse(os.path.exists(thumbnail_path))
+
     def test_add_doc_all(self):
         ps_doc = self.test_add_doc_ps()
         txt_doc = self.test_add_doc_txt()
@@ -112,15 +187,371 @@ class TestDigitalLibrary(unittest.TestCase):
             similar_path = os.path.join(self._tests_dir, 'similar.txt')
             self._library.add_doc(similar_path, set('abc'))
 
+    def test_add_doc_similar_duplicate_rebuilt_index(self):
+        self.test_add_doc_txt()
+        self._library.close()
+        os.remove(os.path.join(self._library_dir, 'similarity.db'))
+        self._library = DigitalLibrary(self._library_dir, XapianIndex, self.DATABASE_CLASS)
+        with self.assertRaises(error.DocumentDuplicatedSimilar):
+            similar_path = os.path.join(self._tests_dir, 'similar.txt')
+            self._library.add_doc(similar_path, set('abc'))
+
+    def test_add_doc_similar_deleted(self):
+        txt_doc = self.test_add_doc_txt()
+        self._library.delete_doc(txt_doc.hash_md5)
+        similar_path = os.path.join(self._tests_dir, 'similar.txt')
+        self._library.add_doc(similar_path, set('abc'))
+
+    def test_import_resume(self):
+        dir_path = os.path.join(self._library_dir, 'import')
+        os.makedirs(dir_path)
+        for name in ('en.pdf', 'es.txt', 'not-retrievable.txt'):
+            shutil.copy(os.path.join(self._tests_dir, name), dir_path)
+        job_id = self._library.start_import(dir_path, set())
+        self.assertEqual(self._library.get_import_progress(job_id), (0, 3))
+        results = self._library.resume_import(job_id, batch_size=1)
+        doc_path, doc = next(results)
+        self.assertEqual(doc_path, os.path.join(dir_path, 'en.pdf'))
+        results.close() # Interrupted after the first document.
+        self._library.close()
+        self._library = DigitalLibrary(self._library_dir, XapianIndex, self.DATABASE_CLASS)
+        jobs = self._library.get_import_jobs(dir_path)
+        self.assertListEqual([job.job_id for job in jobs], [job_id])
+        self.assertEqual(self._library.get_import_progress(job_id), (1, 3))
+        results = list(self._library.resume_import(job_id))
+        self.assertListEqual([os.path.basename(doc_path) for doc_path, _ in results],
+                             ['es.txt', 'not-retrievable.txt'])
+        self.assertEqual(results[0][1].mime_type, 'text/plain')
+        self.assertIsInstance(results[1][1], error.DocumentNotRetrievable)
+        self.assertEqual(self._library.get_import_progress(job_id), (3, 3))
+        self.assertListEqual(self._library.get_import_jobs(dir_path), [])
+        self.assertEqual(self._library.get_doc_count(), 2)
+
+    def test_import_job_matches(self):
+        dir_path = os.path.join(self._library_dir, 'import')
+        os.makedirs(dir_path)
+        job_id = self._library.start_import(dir_path, set(['A', 'b']))
+        self.assertTrue(self._library.import_job_matches(job_id, set(['a', 'B '])))
+        self.assertTrue(self._library.import_job_matches(
+            job_id, set('ab'), DigitalLibrary.PLACEMENT_COPY))
+        self.assertFalse(self._library.import_job_matches(job_id, set('a')))
+        self.assertFalse(self._library.import_job_matches(
+            job_id, set('ab'), DigitalLibrary.PLACEMENT_MOVE))
+
+    def test_watch_dir(self):
+        dir_path = os.path.join(self._library_dir, 'watch')
+        os.makedirs(dir_path)
+        job_id = self._library.start_import(dir_path, set('abc'))
+        watcher = DirectoryWatcher(self._library, job_id, use_inotify=False,
+                                   poll_interval=0.1, settle_time=0)
+        results = []
+        def callback(doc_path, result):
+            results.append((doc_path, result))
+            if len(results) == 2:
+                watcher.stop()
+        thread = threading.Thread(target=watcher.run, args=(callback, ))
+        thread.start()
+        doc_paths = [os.path.join(self._tests_dir, name) for name in ('en.pdf', 'es.txt')]
+        scanner = multiprocessing.Process(target=scan_docs,
+                                          args=(doc_paths, dir_path, self._library_dir))
+        scanner.start()
+        scanner.join()
+        thread.join(60)
+        watcher.stop()
+        self.assertFalse(thread.is_alive())
+        self.assertListEqual(sorted(os.path.basename(doc_path) for doc_path, _ in results),
+                             ['en.pdf', 'es.txt'])
+        self.assertEqual(self._library.get_doc_count(), 2)
+        # The files already imported are not recorded again.
+        self.assertEqual(self._library.update_import(job_id), 0)
+
+    @unittest.skipIf(watch.pyinotify is None, 'pyinotify is not installed')
+    def test_watch_dir_inotify(self):
+        dir_path = os.path.join(self._library_dir, 'watch')
+        os.makedirs(dir_path)
+        job_id = self._library.start_import(dir_path, set('abc'))
+        # Closed just before the watcher starts: it is too recent for the
+        # first walk and inotify does not report it.
+        shutil.copy(os.path.join(self._tests_dir, 'en.pdf'), dir_path)
+        watcher = DirectoryWatcher(self._library, job_id, use_inotify=True,
+                                   poll_interval=60, settle_time=1)
+        results = []
+        def callback(doc_path, result):
+            results.append((doc_path, result))
+            if len(results) == 2:
+                watcher.stop()
+        thread = threading.Thread(target=watcher.run, args=(callback, ))
+        thread.start()
+        time.sleep(0.5)
+        # Reported during the first wait for events.
+        scan_docs([os.path.join(self._tests_dir, 'es.txt')], dir_path, self._library_dir)
+        thread.join(30)
+        watcher.stop()
+        thread.join()
+        self.assertListEqual(sorted(os.path.basename(doc_path) for doc_path, _ in results),
+                             ['en.pdf', 'es.txt'])
+        self.assertEqual(self._library.get_doc_count(), 2)
+
+    def test_index_commit_policy(self):
+        self._library.close()
+        self._library = DigitalLibrary(self._library_dir, XapianIndex, self.DATABASE_CLASS,
+                                       index_commit_docs=2)
+        index_dir = os.path.join(self._library_dir, 'index')
+        txt_doc = self.test_add_doc_txt()
+        self.assertEqual(xapian.Database(index_dir).get_doccount(), 0)
+        self.assertListEqual(self._library.search('', set('a')), []) # Not on disk.
+        self.test_add_doc_ps()
+        self.assertListEqual(self._library.search('', set('a')), [txt_doc.hash_md5])
+        self.assertEqual(xapian.Database(index_dir).get_doccount(), 2)
+        self.test_add_doc_pdf()
+        self._library.delete_docs([txt_doc.hash_md5]) # Committed in a transaction.
+        self.assertEqual(xapian.Database(index_dir).get_doccount(), 2)
+
+    def test_index_commit_interval(self):
+        self._library.close()
+        self._library = DigitalLibrary(self._library_dir, XapianIndex, self.DATABASE_CLASS,
+                                       index_commit_docs=100, index_commit_interval=1)
+        txt_doc = self.test_add_doc_txt()
+        time.sleep(1)
+        # Written to disk by the search, without other modifications.
+        self.assertListEqual(self._library.search('', set('a')), [txt_doc.hash_md5])
+
+    def test_index_transaction_threads(self):
+        txt_doc = self.test_add_doc_txt()
+        pdf_doc = self.test_add_doc_pdf()
+        index = self._library._index
+        in_transaction = []
+        def update_tags():
+            in_transaction.append(index.in_transaction())
+            index.update_tags(txt_doc.hash_md5, set('xyz'))
+        index.begin_transaction()
+        index.delete_doc(pdf_doc.hash_md5)
+        thread = threading.Thread(target=update_tags)
+        thread.start()
+        thread.join(0.5)
+        self.assertTrue(thread.is_alive()) # Waiting for the transaction.
+        index.cancel_transaction()
+        thread.join()
+        # The modification of the other thread was not cancelled.
+        self.assertListEqual(in_transaction, [False])
+        self.assertListEqual(index.search('', set('x')), [txt_doc.hash_md5])
+        self.assertListEqual(index.search('', set('ab')), [pdf_doc.hash_md5])
+
+    def test_index_terms_count(self):
+        txt_doc = self.test_add_doc_txt()
+        self._library.close()
+        index = XapianIndex(os.path.join(self._library_dir, 'index'))
+        terms_count = index.get_doc_terms_count(txt_doc.hash_md5)
+        self.assertGreaterEqual(terms_count, DigitalLibrary.MIN_TERMS)
+        index.update_tags(txt_doc.hash_md5, set('uvwxyz'))
+        self.assertEqual(index.get_doc_terms_count(txt_doc.hash_md5), terms_count)
+        with self.assertRaises(error.DocumentNotFound):
+            index.get_doc_terms_count('0' * 32)
+        index.close()
+        self._library = DigitalLibrary(self._library_dir, XapianIndex, self.DATABASE_CLASS)
+
     def test_add_doc_not_retrievable(self):
         with self.assertRaises(error.DocumentNotRetrievable):
             doc_path = os.path.join(self._tests_dir, 'not-retrievable.txt')
             self._library.add_doc(doc_path, set())
 
+    def test_add_doc_stages(self):
+        with self.assertRaises(error.DocumentNotSupported) as cm:
+            self._library.add_doc(self._tests_dir, set('abc'))
+        self.assertEqual(cm.exception.stage, DigitalLibrary.STAGE_STAT)
+        with self.assertRaises(error.DocumentNotSupported) as cm:
+            self._library.add_doc(os.path.abspath(__file__), set('abc'))
+        self.assertEqual(cm.exception.stage, DigitalLibrary.STAGE_MIME)
+        self.test_add_doc_txt()
+        with self.assertRaises(error.DocumentDuplicatedSimilar) as cm:
+            similar_path = os.path.join(self._tests_dir, 'similar.txt')
+            self._library.add_doc(similar_path, set('abc'))
+        self.assertEqual(cm.exception.stage, DigitalLibrary.STAGE_HASH)
+        with self.assertRaises(error.DocumentNotRetrievable) as cm:
+            doc_path = os.path.join(self._tests_dir, 'not-retrievable.txt')
+            self._library.add_doc(doc_path, set())
+        self.assertEqual(cm.exception.stage, DigitalLibrary.STAGE_CONTENT)
+        self.assertEqual(self._library.get_doc_count(), 1)
+
+    def test_add_docs(self):
+        doc_paths = [os.path.join(self._tests_dir, name)
+                     for name in ('en.pdf', 'es.txt', 'not-retrievable.txt', 'en.ps')]
+        results = self._library.add_docs(doc_paths, set(), batch_size=3)
+        self.assertListEqual([doc_path for doc_path, _ in results], doc_paths)
+        self.assertEqual(results[0][1].mime_type, 'application/pdf')
+        self.assertEqual(results[1][1].mime_type, 'text/plain')
+        self.assertIsInstance(results[2][1], error.DocumentNotRetrievable)
+        self.assertEqual(results[3][1].mime_type, 'application/postscript')
+        self.assertEqual(self._library.get_doc_count(), 3)
+        for doc_path, doc in (results[0], results[1], results[3]):
+            self._assert_docs_equal(doc, self._library.get_doc(doc.hash_md5))
+
+    def test_add_docs_duplicated_in_batch(self):
+        txt_path = os.path.join(self._tests_dir, 'es.txt')
+        similar_path = os.path.join(self._tests_dir, 'similar.txt')
+        results = self._library.add_docs([txt_path, txt_path, similar_path], set('abc'))
+        self.assertEqual(results[0][1].mime_type, 'text/plain')
+        self.assertIsInstance(results[1][1], error.DocumentDuplicatedExact)
+        self.assertIsInstance(results[2][1], error.DocumentDuplicatedSimilar)
+        self.assertEqual(self._library.get_doc_count(), 1)
+
+    def test_add_docs_similarity_failed(self):
+        txt_path = os.path.join(self._tests_dir, 'es.txt')
+        def add_hashes(hashes):
+            raise IOError()
+        self._library._similarity.add_hashes = add_hashes
+        results = self._library.add_docs([txt_path], set('abc'))
+        # The batch is kept and the similarity index is rebuilt when reopened.
+        doc = results[0][1]
+        self.assertTrue(os.path.isfile(doc.document_abspath))
+        self.assertListEqual(self._library.search('', set('a')), [doc.hash_md5])
+        self._library.close()
+        self._library = DigitalLibrary(self._library_dir, XapianIndex, self.DATABASE_CLASS)
+        with self.assertRaises(error.DocumentDuplicatedSimilar):
+            similar_path = os.path.join(self._tests_dir, 'similar.txt')
+            self._library.add_doc(similar_path, set('abc'))
+
+    def test_add_docs_processes(self):
+        self._library.close()
+        self._library = DigitalLibrary(self._library_dir, XapianIndex,
+                                       self.DATABASE_CLASS, processes=2)
+        doc_paths = [os.path.join(self._tests_dir, name)
+                     for name in ('en.djvu', 'en.pdf', 'es.txt', 'en.ps')]
+        results = self._library.add_docs(doc_paths, set('ab'), batch_size=2)
+        self.assertListEqual([doc_path for doc_path, _ in results], doc_paths)
+        for doc_path, doc in results:
+            self.assertTrue(os.path.isfile(doc.document_abspath))
+            self._assert_docs_equal(doc, self._library.get_doc(doc.hash_md5))
+        self.assertEqual(self._library.get_doc_count(), 4)
+
+    def test_add_doc_hashes(self):
+        pdf_path = os.path.join(self._tests_dir, 'en.pdf')
+        with open(pdf_path, 'rb') as file:
+            pdf_data = file.read()
+        doc = self._library.add_doc(pdf_path, set())
+        self.assertEqual(doc.document_size, len(pdf_data))
+        self.assertEqual(doc.hash_md5, hashlib.md5(pdf_data).hexdigest())
+        self.assertEqual(doc.hash_ssdeep, ssdeep.hash(pdf_data))
+        with open(doc.document_abspath, 'rb') as file:
+            self.assertEqual(file.read(), pdf_data)
+
+    def test_add_doc_hardlink(self):
+        pdf_path = os.path.join(self._tests_dir, 'en.pdf')
+        doc = self._library.add_doc(pdf_path, set(), DigitalLibrary.PLACEMENT_HARDLINK)
+        self.assertTrue(os.path.samefile(pdf_path, doc.document_abspath))
+        self._library.delete_doc(doc.hash_md5)
+        self.assertTrue(os.path.isfile(pdf_path))
+
+    def test_add_doc_sendfile(self):
+        pdf_path = os.path.join(self._tests_dir, 'en.pdf')
+        doc = self._library.add_doc(pdf_path, set(), DigitalLibrary.PLACEMENT_SENDFILE)
+        with open(pdf_path, 'rb') as file:
+            pdf_data = file.read()
+        with open(doc.document_abspath, 'rb') as file:
+            self.assertEqual(file.read(), pdf_data)
+        # Copied by sendfile, not by the fallback.
+        self.assertIsNotNone(ingest._libc_sendfile)
+        sendfile_path = os.path.join(self._library_dir, 'sendfile.pdf')
+        ingest._sendfile(pdf_path, sendfile_path)
+        with open(sendfile_path, 'rb') as file:
+            self.assertEqual(file.read(), pdf_data)
+
+    def test_add_docs_move(self):
+        doc_paths = []
+        for name in ('en.pdf', 'not-retrievable.txt'):
+            doc_path = os.path.join(self._library_dir, name)
+            shutil.copyfile(os.path.join(self._tests_dir, name), doc_path)
+            doc_paths.append(doc_path)
+        results = self._library.add_docs(doc_paths, set(),
+                                         placement=DigitalLibrary.PLACEMENT_MOVE)
+        self.assertTrue(os.path.isfile(results[0][1].document_abspath))
+        self.assertFalse(os.path.exists(doc_paths[0]))
+        self.assertIsInstance(results[1][1], error.DocumentNotRetrievable)
+        self.assertTrue(os.path.isfile(doc_paths[1]))
+
     def test_get_doc_not_found(self):
         with self.assertRaises(error.DocumentNotFound):
             self._library.get_doc('7d78df0a62e07eeeef6b942abe5bdc7f')
 
+    def test_get_docs(self):
+        txt_doc = self.test_add_doc_txt()
+        pdf_doc = self.test_add_doc_pdf()
+        docs = self._library.get_docs([pdf_doc.hash_md5, txt_doc.hash_md5, pdf_doc.hash_md5])
+        self.assertEqual(len(docs), 3)
+        self._assert_docs_equal(docs[0], pdf_doc)
+        self._assert_docs_equal(docs[1], txt_doc)
+        self._assert_docs_equal(docs[2], pdf_doc)
+        self.assertListEqual(self._library.get_docs([]), [])
+        with self.assertRaises(error.DocumentNotFound):
+            self._library.get_docs([txt_doc.hash_md5, '7d78df0a62e07eeeef6b942abe5bdc7f'])
+
+    def test_database_migration(self):
+        txt_doc = self.test_add_doc_txt()
+        self._library.close()
+        database_file = os.path.join(self._library_dir, 'database.db')
+        conn = sqlite3.connect(database_file)
+        conn.execute('DROP INDEX documents_document_size')
+        conn.execute('PRAGMA user_version = 0')
+        conn.commit()
+        conn.close()
+        self._library = DigitalLibrary(self._library_dir, XapianIndex, self.DATABASE_CLASS)
+        self._assert_docs_equal(self._library.get_doc(txt_doc.hash_md5), txt_doc)
+        conn = sqlite3.connect(database_file)
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        indexes = [row[0] for row in
+                   conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")]
+        conn.close()
+        self.assertEqual(version, len(SQLITE_MIGRATIONS))
+        self.assertIn('documents_document_size', indexes)
+
+    def test_get_doc_cache(self):
+        txt_doc = self.test_add_doc_txt()
+        hits, misses = self._library.get_doc_cache_stats()
+        doc = self._library.get_doc(txt_doc.hash_md5)
+        doc.tags.add('z') # The cached document is not modified.
+        self._assert_docs_equal(self._library.get_doc(txt_doc.hash_md5), txt_doc)
+        self.assertEqual(self._library.get_doc_cache_stats(), (hits + 1, misses + 1))
+        self._library.update_tags(txt_doc.hash_md5, set('xyz'))
+        self.assertSetEqual(self._library.get_doc(txt_doc.hash_md5).tags, set('xyz'))
+        self._library.rename_tag('x', 'w')
+        self.assertSetEqual(self._library.get_docs([txt_doc.hash_md5])[0].tags, set('wyz'))
+        self._library.delete_doc(txt_doc.hash_md5)
+        with self.assertRaises(error.DocumentNotFound):
+            self._library.get_doc(txt_doc.hash_md5)
+
+    def test_database_threads(self):
+        txt_doc = self.test_add_doc_txt()
+        counts = []
+        def get_tag_counts():
+            for _ in xrange(10):
+                counts.append(self._library.get_all_tag_counts())
+        # More threads than connections kept by the pool of SQLAlchemyDatabase.
+        threads = [threading.Thread(target=get_tag_counts)
+                   for _ in xrange(3 * SQLAlchemyDatabase.POOL_SIZE)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(counts), 10 * len(threads))
+        for tag_counts in counts:
+            self.assertDictEqual(tag_counts, dict([(tag, 1) for tag in txt_doc.tags]))
+
+    def test_get_doc_threads(self):
+        txt_doc = self.test_add_doc_txt()
+        docs = []
+        def get_doc():
+            docs.append(self._library.get_doc(txt_doc.hash_md5))
+        threads = [threading.Thread(target=get_doc) for _ in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(docs), 4)
+        for doc in docs:
+            self._assert_docs_equal(doc, txt_doc)
+        self._library.update_tags(txt_doc.hash_md5, set('xyz'))
+        self.assertSetEqual(self._library.get_doc(txt_doc.hash_md5).tags, set('xyz'))
+
     def test_delete_doc(self):
         pdf_doc = self.test_add_doc_pdf()
         doc_path = pdf_doc.document_abspath
@@ -135,6 +566,19 @@ class TestDigitalLibrary(unittest.TestCase):
         with self.assertRaises(error.DocumentNotFound):
             self._library.get_doc(pdf_doc.hash_md5)
 
+    def test_delete_docs(self):
+        docs = [self.test_add_doc_pdf(), self.test_add_doc_txt(), self.test_add_doc_ps()]
+        doc_paths = [doc.document_abspath for doc in docs]
+        self._library.delete_docs([doc.hash_md5 for doc in docs[:2]])
+        self.assertFalse(os.path.exists(doc_paths[0]))
+        self.assertFalse(os.path.exists(doc_paths[1]))
+        self.assertTrue(os.path.exists(doc_paths[2]))
+        self.assertEqual(self._library.get_doc_count(), 1)
+        self.assertListEqual(self._library.search('', set()), [docs[2].hash_md5])
+        with self.assertRaises(error.DocumentNotFound):
+            self._library.delete_docs([docs[2].hash_md5, docs[0].hash_md5])
+        self.assertEqual(self._library.get_doc_count(), 1)
+
     def test_add_doc_previously_imported(self):
         pdf_doc = self.test_add_doc_pdf()
         self._library.delete_doc(pdf_doc.hash_md5)
@@ -174,6 +618,14 @@ class TestDigitalLibrary(unittest.TestCase):
         self.assertListEqual(self._library.search('', set('c')), [])
         self.assertListEqual(self._library.search('', set('b')), [original.hash_md5])
 
+    def test_rename_tag_same(self):
+        original = self.test_add_doc_txt()
+        self._library.rename_tag('a', 'A')
+        self._library._database.rename_tag(u'a', u'a')
+        self.assertSetEqual(self._library.get_all_tags(), set('abc'))
+        self.assertSetEqual(self._library.get_doc(original.hash_md5).tags, set('abc'))
+        self.assertListEqual(self._library.search('', set('a')), [original.hash_md5])
+
     def test_update_tags(self):
         doc = self.test_add_doc_txt()
         self.assertListEqual(self._library.search('', set('xyz')), [])
@@ -185,12 +637,52 @@ class TestDigitalLibrary(unittest.TestCase):
         self._library.update_tags(doc.hash_md5, set(u'áéíóóñ'))
         self.assertListEqual(self._library.search('', set(u'áéíóóñ')), [doc.hash_md5])
 
+    def test_update_tags_partial(self):
+        doc = self.test_add_doc_txt()
+        self._library.update_tags(doc.hash_md5, set(u'bcá'))
+        self._library.update_tags(doc.hash_md5, set(u'cáé'))
+        self.assertSetEqual(self._library.get_doc(doc.hash_md5).tags, set(u'cáé'))
+        self.assertSetEqual(self._library.get_all_tags(), set(u'cáé'))
+        self.assertListEqual(self._library.search('', set('a')), [])
+        self.assertListEqual(self._library.search('', set('b')), [])
+        self.assertListEqual(self._library.search('', set(u'cáé')), [doc.hash_md5])
+
     def test_update_tags_not_retrievable(self):
         doc_path = os.path.join(self._tests_dir, 'not-retrievable.txt')
         doc = self._library.add_doc(doc_path, set('abc'))
         with self.assertRaises(error.DocumentNotRetrievable):
             self._library.update_tags(doc.hash_md5, set())
 
+    def test_update_tags_bulk(self):
+        txt_doc = self.test_add_doc_txt()
+        ps_doc = self.test_add_doc_ps()
+        self._library.update_tags_bulk({txt_doc.hash_md5: set('xy'),
+                                        ps_doc.hash_md5: set('yz')})
+        self.assertSetEqual(self._library.get_doc(txt_doc.hash_md5).tags, set('xy'))
+        self.assertSetEqual(self._library.get_doc(ps_doc.hash_md5).tags, set('yz'))
+        self.assertListEqual(sorted(self._library.search('', set('y'))),
+                             sorted([txt_doc.hash_md5, ps_doc.hash_md5]))
+
+    def test_update_tags_bulk_not_retrievable(self):
+        txt_doc = self.test_add_doc_txt()
+        doc_path = os.path.join(self._tests_dir, 'not-retrievable.txt')
+        doc = self._library.add_doc(doc_path, set('abc'))
+        with self.assertRaises(error.DocumentNotRetrievable):
+            self._library.update_tags_bulk({txt_doc.hash_md5: set('x'),
+                                            doc.hash_md5: set()})
+        self.assertSetEqual(self._library.get_doc(txt_doc.hash_md5).tags, txt_doc.tags)
+
+    def test_add_remove_tags(self):
+        hash_list = [self.test_add_doc_txt().hash_md5, self.test_add_doc_ps().hash_md5]
+        self._library.add_tags(hash_list, set('xy'))
+        self.assertSetEqual(self._library.get_doc(hash_list[0]).tags, set('abcxy'))
+        self.assertSetEqual(self._library.get_doc(hash_list[1]).tags, set('abcdxy'))
+        self._library.remove_tags(hash_list, set('adx'))
+        self.assertSetEqual(self._library.get_doc(hash_list[0]).tags, set('bcy'))
+        self.assertSetEqual(self._library.get_doc(hash_list[1]).tags, set('bcy'))
+        self.assertSetEqual(self._library.get_all_tags(), set('bcy'))
+        self.assertListEqual(self._library.search('', set('d')), [])
+
     def test_get_doc_count(self):
         self.test_add_doc_ps()
         self.assertEqual(self._library.get_doc_count(), 1)
@@ -211,6 +703,18 @@ class TestDigitalLibrary(unittest.TestCase):
         self.assertEqual(self._library.get_tag_count('b'), 3)
         self.assertEqual(self._library.get_tag_count('a'), 4)
 
+    def test_get_all_tag_counts(self):
+        self.test_add_doc_ps()
+        self.test_add_doc_txt()
+        self.test_add_doc_pdf()
+        djvu_doc = self.test_add_doc_djvu()
+        self.assertDictEqual(self._library.get_all_tag_counts(),
+                             {'a': 4, 'b': 3, 'c': 2, 'd': 1})
+        self._library.delete_doc(djvu_doc.hash_md5)
+        self._library.update_tags(self.test_add_doc_djvu().hash_md5, set('e'))
+        self.assertDictEqual(self._library.get_all_tag_counts(),
+                             {'a': 3, 'b': 3, 'c': 2, 'd': 1, 'e': 1})
+
     def test_get_tag_freq(self):
         self.test_add_doc_ps()
         self.test_add_doc_txt()
@@ -249,6 +753,54 @@ class TestDigitalLibrary(unittest.TestCase):
         results = self._library.search('+VEDA EDA', set('abc'))
         self.assertListEqual(results, [txt_doc.hash_md5])
 
+    def test_search_results(self):
+        txt_doc = self.test_add_doc_txt()
+        pdf_doc = self.test_add_doc_pdf()
+        ps_doc = self.test_add_doc_ps()
+        results = self._library.search_results('', set(), chunk_size=2)
+        self.assertEqual(results.matches_estimated, 3)
+        self.assertEqual(results.matches_lower_bound, 3)
+        self.assertEqual(results.matches_upper_bound, 3)
+        all_hashes = list(results)
+        self.assertSetEqual(set(all_hashes),
+                            set([txt_doc.hash_md5, pdf_doc.hash_md5, ps_doc.hash_md5]))
+        self.assertListEqual(results.get_page(1, 1), all_hashes[1:2])
+        self.assertListEqual(results.get_page(1, 5), all_hashes[1:])
+        self.assertListEqual(self._library.search('', set(), 1, 1), all_hashes[1:2])
+        self.assertListEqual(self._library.search('', set()), all_hashes)
+        results = self._library.search_results('', set('d'))
+        self.assertEqual(results.matches_estimated, 1)
+        self.assertListEqual(list(results), [ps_doc.hash_md5])
+
+    def test_search_languages(self):
+        txt_doc = self.test_add_doc_txt()
+        pdf_doc = self.test_add_doc_pdf()
+        results = self._library.search('+VEDA EDA', set(), languages=['es'])
+        self.assertListEqual(results, [txt_doc.hash_md5])
+        results = self._library.search('', set(), languages=['en', 'fr'])
+        self.assertListEqual(results, [pdf_doc.hash_md5])
+        results = self._library.search('+VEDA EDA', set(), languages=['en', 'es'])
+        self.assertListEqual(results, [pdf_doc.hash_md5, txt_doc.hash_md5])
+
+    def test_search_threads(self):
+        txt_doc = self.test_add_doc_txt()
+        results = {}
+        def search(name):
+            results[name] = self._library.search('', set())
+        with self._library._index.transaction():
+            pdf_doc = self.test_add_doc_pdf()
+            thread = threading.Thread(target=search, args=('transaction', ))
+            thread.start()
+            thread.join()
+        thread = threading.Thread(target=search, args=('committed', ))
+        thread.start()
+        thread.join()
+        self.assertListEqual(results['transaction'], [txt_doc.hash_md5])
+        self.assertSetEqual(set(results['committed']),
+                            set([txt_doc.hash_md5, pdf_doc.hash_md5]))
+        self.assertSetEqual(set(self._library.search('', set())),
+                            set([txt_doc.hash_md5, pdf_doc.hash_md5]))
+
     def _assert_docs_equal(self, x, y):
         self.assertEqual(x.hash_md5, y.hash_md5)
         self.assertEqual(x.hash_ssdeep, y.hash_ssdeep)
@@ -263,5 +815,10 @@ class TestDigitalLibrary(unittest.TestCase):
         self.assertSetEqual(x.tags, y.tags)
 
 
+class TestDigitalLibrarySQLite(TestDigitalLibrary):
+
+    DATABASE_CLASS = SQLiteDatabase
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)